@@ -123,14 +123,41 @@ class TokenValidatedHandler(webapp2.RequestHandler):
         return project
 
 
-def validate_token(header):
+def _signature(handler, header):
+    """
+    Returns the SHA1 HMAC hex digest provided in header, or None having
+    written an error response
+    """
+    got = handler.request.headers.get(header, default="")
+    if not got:
+        logging.warning("No %s header was provided with result", header)
+        handler.response.write("Didn't find %s header in request" % header)
+        handler.response.set_status(404)
+        return None
+    try:
+        hashtype, got = got.split("=")
+    except ValueError:
+        logging.warning("Got a webhook with a HMAC hashtype of %s", got)
+        handler.response.write("Invalid HMAC digest %s" % got)
+        handler.response.set_status(404)
+        return None
+    if hashtype != "sha1":
+        logging.warning("Got a webhook with a HMAC hashtype of %s", hashtype)
+        handler.response.write("Unable to process HMAC using hash %s" % hashtype)
+        handler.response.set_status(404)
+        return None
+    return got
+
+
+def validate_token(header, prefix=None):
     """
     For webhooks, results from Travis-CI etc the POST requests aren't user authenticated.
 
     We use an SHA1 HMAC digest with a custom header to validate the origin of the request
 
     This decorator handles everything and makes sure we have a valid project for the
-    request.
+    request.  If given, prefix(handler, *args, **kwargs) returns what is signed
+    ahead of the body, see validate_stream_token.
     """
     def _wrap(handler_method):
         def check_token(self, user, repo, *args, **kwargs):
@@ -140,28 +167,14 @@ def validate_token(header):
                 self.response.set_status(404)
                 return
 
-            key = str(project.secret)  # Convert from unicode to a string
-            logging.info("Using key: %s (%s)", key, type(key))
-            exp = hmac.new(key, self.request.body, hashlib.sha1).hexdigest()
-            got = self.request.headers.get(header, default="")
-            if not got:
-                logging.warning("No %s header was provided with result", header)
-                self.response.write("Didn't find %s header in request" % header)
-                self.response.set_status(404)
-                return
-            try:
-                hashtype, got = got.split("=")
-            except ValueError:
-                logging.warning("Got a webhook with a HMAC hashtype of %s", got)
-                self.response.write("Invalid HMAC digest %s" % got)
-                self.response.set_status(404)
-                return
-            if hashtype != "sha1":
-                logging.warning("Got a webhook with a HMAC hashtype of %s", hashtype)
-                self.response.write("Unable to process HMAC using hash %s" % hashtype)
-                self.response.set_status(404)
+            got = _signature(self, header)
+            if got is None:
                 return
 
+            key = str(project.secret)  # Convert from unicode to a string
+            logging.info("Using key: %s (%s)", key, type(key))
+            signed = prefix(self, *args, **kwargs) if prefix is not None else ""
+            exp = hmac.new(key, signed + self.request.body, hashlib.sha1).hexdigest()
             if exp != got:
                 logging.warning("%s didn't match (got %s but expected %s for %d bytes (%d ascii)",
                                 header, got, exp, len(self.request.body), len(repr(self.request.body)))
@@ -178,6 +191,74 @@ def validate_token(header):
         return check_token
     return _wrap
 
+
+class SignedBody(object):
+    """
+    The body of a request, read in chunks while computing its HMAC so that
+    we never hold all of it in memory
+
+    Iterate over it to consume the body, then check verified before
+    trusting anything that was read.  prefix is signed ahead of the body.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, request, key, expected, prefix=""):
+        self._stream = request.body_file
+        self._hmac = hmac.new(key, prefix, hashlib.sha1)
+        self.signature = expected
+        self._complete = False
+        self.length = 0
+
+    def __iter__(self):
+        while True:
+            chunk = self._stream.read(self.chunk_size)
+            if not chunk:
+                break
+            self._hmac.update(chunk)
+            self.length += len(chunk)
+            yield chunk
+        self._complete = True
+
+    @property
+    def digest(self):
+        return self._hmac.hexdigest()
+
+    @property
+    def verified(self):
+        """
+        True once the whole body has been read and matched the signature
+        """
+        return self._complete and self.digest == self.signature
+
+
+def validate_stream_token(header, prefix=None):
+    """
+    As validate_token but for large uploads: the body isn't read up front,
+    instead the handler is passed a SignedBody to stream it from.
+
+    If given, prefix(handler, *args, **kwargs) returns what is signed ahead
+    of the body, to bind the signature to e.g. where the body was sent.
+
+    The handler must not act on anything it read until body.verified
+    """
+    def _wrap(handler_method):
+        def check_token(self, user, repo, *args, **kwargs):
+            project = self.get_project(user, repo)
+            if project is None:
+                logging.warning("Got request for %s/%s which didn't exist", user, repo)
+                self.response.set_status(404)
+                return
+
+            got = _signature(self, header)
+            if got is None:
+                return
+
+            signed = prefix(self, *args, **kwargs) if prefix is not None else ""
+            body = SignedBody(self.request, str(project.secret), got, prefix=signed)
+            return handler_method(self, project, body, *args, **kwargs)
+        return check_token
+    return _wrap
+
 class BaseSessionHandler(webapp2.RequestHandler):
 
     def dispatch(self):
@@ -86,6 +86,22 @@ class OCBaseModel(ndb.Model):
                                             repr(fetch.to_dict()))
         return fetch
 
+    def covers(self, other):
+        """
+        True if merge(other) would leave us unchanged, so there's no need
+        to write anything back
+        """
+        for name, value in other.to_dict().iteritems():
+            if name == "created":
+                continue
+            mine = getattr(self, name)
+            if isinstance(mine, list):
+                if any(x not in mine for x in value):
+                    return False
+            elif not mine and value:
+                return False
+        return True
+
     def merge(self, other):
         """
         Combine any changes in "other" into self
@@ -120,3 +136,23 @@ class OCBaseModel(ndb.Model):
             elif mine and mine != value:
                 logging.warning("Merge conflict self.%s=%s vs %s",
                                 name, repr(mine), repr(value))
+
+
+@ndb.transactional(xg=True)
+def insert_or_update_multi(*entities):
+    """
+    insert_or_update() several entities (of up to 25 entity groups) in a
+    single cross-group transaction, fetching them all in one go
+
+    Returns the stored entities
+    """
+    stored = ndb.get_multi([entity.key for entity in entities])
+    for index, (entity, fetch) in enumerate(zip(entities, stored)):
+        if fetch is None:
+            logging.debug("Inserted %s (%s)", entity.__class__.__name__,
+                                                repr(entity.to_dict()))
+            stored[index] = entity
+        else:
+            fetch.merge(entity)
+    ndb.put_multi(stored)
+    return stored
@@ -25,6 +25,8 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import datetime
+import hashlib
 import logging
 
 
@@ -84,6 +86,38 @@ class Push(OCBaseModel):
     compare             = ndb.StringProperty(indexed=False)
 
 
+class PushAlias(OCBaseModel):
+    """
+    Maps a commit we made in the fork (Push.fork_merge or Push.travis_update)
+    back to the Push that caused it, so a build of that commit can find its
+    Push by key rather than a query
+
+    Key:                sha1 of the commit in the fork
+    """
+    push                = ndb.KeyProperty(Push, indexed=False)
+
+    @staticmethod
+    def record_async(commit, push):
+        return PushAlias(id=commit, push=push.key).put_async()
+
+
+class EncryptedVariable(OCBaseModel):
+    """
+    Ciphertext of a secure variable encrypted with a Travis repository key
+
+    RSA encryption is randomised, so remembering the ciphertext means the
+    generated .travis.yml only changes if the key or the variable does.
+
+    Key:                digest(fingerprint, plaintext)
+    """
+    fingerprint         = ndb.StringProperty()
+    ciphertext          = ndb.TextProperty()
+
+    @staticmethod
+    def digest(fingerprint, plaintext):
+        return hashlib.sha256("%s\n%s" % (fingerprint, plaintext)).hexdigest()
+
+
 class Shield(OCBaseModel):
     """
     Representation of a shield object
@@ -151,11 +185,17 @@ class Project(OCBaseModel):
 class JUnitTestCase(OCBaseModel):
     """
     JUnit test case - a single test
+
+    Any text (failure messages, output) is kept in a JUnitTestOutput so
+    that results stay small.  The text properties here are only set on
+    results stored before that.
     """
     classname           = ndb.StringProperty()
     name                = ndb.StringProperty()
     time                = ndb.FloatProperty()
     passed              = ndb.BooleanProperty()
+    outcome             = ndb.StringProperty(choices=["passed", "failed", "error", "skipped"])
+    has_output          = ndb.BooleanProperty(default=False)
     failure             = ndb.TextProperty()    # Not indexed
     error               = ndb.TextProperty()    # Not indexed
     skipped             = ndb.TextProperty()    # Not indexed
@@ -163,6 +203,20 @@ class JUnitTestCase(OCBaseModel):
     stdout              = ndb.TextProperty()    # Not indexed
 
 
+class JUnitTestOutput(OCBaseModel):
+    """
+    The text of a test case, only loaded when somebody wants to read it
+
+    Parent:             JUnitTestResult
+    Key:                index of the test case in JUnitTestResult.testcases (from 1)
+    """
+    failure             = ndb.TextProperty(compressed=True)
+    error               = ndb.TextProperty(compressed=True)
+    skipped             = ndb.TextProperty(compressed=True)
+    stderr              = ndb.TextProperty(compressed=True)
+    stdout              = ndb.TextProperty(compressed=True)
+
+
 
 
 
@@ -181,6 +235,7 @@ class TravisJob(OCBaseModel):
     duration            = ndb.FloatProperty()
     log_id              = ndb.IntegerProperty()
     logfiles            = ndb.StringProperty(repeated=True)
+    rendered            = ndb.StringProperty(repeated=True, indexed=False)   # HTML of logfiles
     valid               = ndb.BooleanProperty()
 
 
@@ -203,10 +258,12 @@ class TravisJob(OCBaseModel):
                 TravisJob.number == valid_job.number)).fetch()
 
         for duplicate in duplicates:
-            if duplicate.travis_id == valid_job.travis_id:
+            if duplicate.travis_id == valid_job.travis_id or duplicate.valid is False:
                 continue
-
-            logging.info("Removing duplicate TravisJob: %s",
+            # The query may be stale and other purges may be running, only
+            # one of us gets to release the logs
+            if TravisJob._invalidate(duplicate.key):
+                logging.info("Removing duplicate TravisJob: %s",
                                                 repr(duplicate.to_dict()))
 
             results = JUnitTestResult.query(
@@ -216,11 +273,25 @@ class TravisJob(OCBaseModel):
                                                 repr(result.to_dict()))
                 result.valid = False
                 result.put_async()
-            duplicate.valid = False
-            duplicate.put_async()
 
         logging.debug("Purge of duplicate TravisJobs complete")
 
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _invalidate(key):
+        """
+        Mark a job invalid and release its logs, unless that's been done
+        already.  Returns True if we did it.
+        """
+        job = key.get()
+        if job is None or job.valid is False:
+            return False
+        job.valid = False
+        job.put()
+        for logfile in job.logfiles:
+            LogBlob.release(logfile)
+        return True
+
 
     def purge_async(self):
         """
@@ -231,8 +302,230 @@ class TravisJob(OCBaseModel):
         taskqueue.add(url="/jobs/%d/purge" % self.travis_id)
 
 
+    def render_async(self, version):
+        """
+        Queue a background task to render the HTML of any logfiles that
+        don't have it yet
+
+        The task is named after the logfiles and the version of the
+        renderer, so that only one is ever queued for the same work however
+        often we're asked.
+        """
+        digest = hashlib.sha1(version)
+        for logfile in sorted(self.logfiles):
+            digest.update("\0" + logfile)
+        try:
+            taskqueue.add(url="/jobs/%d/render" % self.travis_id,
+                          name="render-%d-%s" % (self.travis_id, digest.hexdigest()))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            return
+        logging.info("Queued background task to render logs of job %d", self.travis_id)
+
+
+
 
 
+class LogBlob(OCBaseModel):
+    """
+    A stored log, shared by every job that uploaded the same content
+
+    refs counts the TravisJobs referring to it, once it drops to zero the
+    log is deleted after a grace period.  signatures are the HMACs of
+    uploads that produced it so that a re-upload can be recognised before
+    it is read.
+
+    Key is the filename /buildlogs/blobs/<sha256>/<name>.gz
+    """
+    refs                = ndb.IntegerProperty(default=0, indexed=False)
+    signatures          = ndb.StringProperty(repeated=True)
+    updated             = ndb.DateTimeProperty(auto_now=True)
+
+    # Seconds an unreferenced log is kept in case it gets uploaded again
+    _grace = 24 * 60 * 60
+
+    @staticmethod
+    @ndb.transactional
+    def reference(filename, signature=None):
+        blob = LogBlob.get_by_id(filename) or LogBlob(id=filename)
+        blob.refs += 1
+        if signature is not None and signature not in blob.signatures:
+            blob.signatures.append(signature)
+        blob.put()
+
+    @staticmethod
+    @ndb.transactional
+    def release(filename):
+        """
+        Drop a reference, scheduling collection if it was the last
+        """
+        blob = LogBlob.get_by_id(filename)
+        if blob is None:
+            return
+        blob.refs -= 1
+        blob.put()
+        if blob.refs <= 0:
+            taskqueue.add(url="/logs/collect", params={"filename": filename},
+                          countdown=LogBlob._grace, transactional=True)
+
+    @staticmethod
+    @ndb.transactional
+    def collect(filename):
+        """
+        Forget the log if it's still unreferenced, returns True if so
+        """
+        blob = LogBlob.get_by_id(filename)
+        if blob is None or blob.refs > 0:
+            return False
+        blob.key.delete()
+        return True
+
+
+class LogUploadSession(OCBaseModel):
+    """
+    A log being uploaded in numbered chunks, which may arrive in any order
+    and be resent, before being composed into a LogBlob
+
+    chunks[n] is the object holding chunk n, or "" if it hasn't arrived.
+    count is how many make up the log, once the client has told us.
+
+    Key is a random session id
+    """
+    project             = ndb.KeyProperty(Project)
+    travis_job          = ndb.KeyProperty(TravisJob)
+    name                = ndb.StringProperty(indexed=False)
+    chunks              = ndb.StringProperty(repeated=True, indexed=False)
+    count               = ndb.IntegerProperty(indexed=False)
+    state               = ndb.StringProperty(default="open",
+                                             choices=["open", "finalizing", "complete", "failed",
+                                                      "expired"])
+    logfile             = ndb.StringProperty(indexed=False)
+    updated             = ndb.DateTimeProperty(auto_now=True)
+
+    # GCS compose can't take more components than this
+    max_chunks = 1024
+
+    # Seconds a session may go without a chunk before it's abandoned
+    lifetime = 24 * 60 * 60
+
+    def expire_async(self, countdown=None):
+        """
+        Queue a background task to abandon the session if it's left open
+        """
+        taskqueue.add(url="/logs/sessions/%s/expire" % self.key.id(),
+                      countdown=self.lifetime if countdown is None else countdown)
+
+    @property
+    def received(self):
+        return [n for n, chunk in enumerate(self.chunks) if chunk]
+
+    @staticmethod
+    @ndb.transactional
+    def add_chunk(session_id, number, obj):
+        """
+        Record that obj holds chunk number
+
+        Returns the object previously holding it, if any, or None if the
+        session isn't open any more
+        """
+        session = LogUploadSession.get_by_id(session_id)
+        if session is None or session.state != "open":
+            return None
+        if len(session.chunks) <= number:
+            session.chunks.extend([""] * (number + 1 - len(session.chunks)))
+        previous = session.chunks[number]
+        session.chunks[number] = obj
+        session.put()
+        return previous
+
+    @staticmethod
+    @ndb.transactional
+    def finalize(session_id, count):
+        """
+        Close the session if chunks 0 .. count-1 have all arrived
+
+        Returns the chunk numbers still missing
+        """
+        session = LogUploadSession.get_by_id(session_id)
+        missing = [n for n in range(count)
+                        if n >= len(session.chunks) or not session.chunks[n]]
+        if session.state == "open" and not missing:
+            session.count = count
+            session.state = "finalizing"
+            session.put()
+            taskqueue.add(url="/logs/sessions/%s/finalize" % session_id, transactional=True)
+        return missing
+
+    @staticmethod
+    @ndb.transactional
+    def expire(session_id):
+        """
+        Abandon the session if it's been open for lifetime without a chunk
+
+        Returns (objects holding its chunks to delete, seconds until it
+        should be checked again or None)
+        """
+        session = LogUploadSession.get_by_id(session_id)
+        if session is None or session.state != "open":
+            return [], None
+        idle = (datetime.datetime.utcnow() - session.updated).total_seconds()
+        if idle < LogUploadSession.lifetime:
+            return [], LogUploadSession.lifetime - idle
+        session.state = "expired"
+        session.put()
+        return [chunk for chunk in session.chunks if chunk], None
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def complete(session_id, filename):
+        """
+        Mark a finalizing session as stored in filename, taking its
+        reference to the LogBlob
+
+        Returns False if the session had already been completed, so a
+        retried finalize task doesn't take another reference
+        """
+        session = LogUploadSession.get_by_id(session_id)
+        if session is None or session.state != "finalizing":
+            return False
+        LogBlob.reference(filename)
+        session.state = "complete"
+        session.logfile = filename
+        session.put()
+        return True
+
+
+class LogSummary(OCBaseModel):
+    """
+    Errors, warnings and assertion failures found in a log as it was
+    uploaded, so the build page can summarise them without reading the log
+
+    entries are [kind, line, offset, text] where line (from 0) and offset
+    are where the line starts in the log
+
+    Key is the filename of the log
+    """
+    travis_job          = ndb.KeyProperty(TravisJob)
+    tools               = ndb.StringProperty(repeated=True, indexed=False)
+    errors              = ndb.IntegerProperty(indexed=False)
+    warnings            = ndb.IntegerProperty(indexed=False)
+    assertions          = ndb.IntegerProperty(indexed=False)
+    entries             = ndb.JsonProperty(compressed=True)
+
+
+class LogIndex(OCBaseModel):
+    """
+    Line index of a rendered log
+
+    The log is stored as a series of gzip members each holding block_lines
+    lines, offsets holds where each starts (plus the end of the last) so
+    the block holding line n starts at offsets[n // block_lines].
+
+    Key is the filename of the rendered log
+    """
+    lines               = ndb.IntegerProperty(indexed=False)
+    block_lines         = ndb.IntegerProperty(indexed=False)
+    offsets             = ndb.JsonProperty(compressed=True)
+
 
 class TravisBuild(OCBaseModel):
     """
@@ -251,6 +544,61 @@ class TravisBuild(OCBaseModel):
     valid               = ndb.BooleanProperty()
 
 
+class TestCaseDictionary(OCBaseModel):
+    """
+    Stable integer ids for the testcases of a project, so that results only
+    need to store ids and can be compared id for id
+
+    Testcases are identified by (classname, name, occurrence) where
+    occurrence counts earlier testcases of the same classname and name in
+    the suite, so a suite can repeat a name without the results colliding.
+
+    Key is the project full_name
+    """
+    names               = ndb.JsonProperty(compressed=True)     # [classname, name(, occurrence)] by id
+
+    @staticmethod
+    def _identity(names):
+        return (names[0], names[1], names[2] if len(names) > 2 else 0)
+
+    def ids(self):
+        return dict((TestCaseDictionary._identity(names), i) for i, names in enumerate(self.names))
+
+    @staticmethod
+    def intern(project_key, testcases):
+        """
+        Returns the ids of testcases, a list of (classname, name, occurrence),
+        assigning new ids as needed
+
+        Usually every testcase is known already, so we only take the
+        transaction when there's something to add.
+        """
+        dictionary = TestCaseDictionary.get_by_id(project_key.id())
+        if dictionary is not None:
+            ids = dictionary.ids()
+            if all(testcase in ids for testcase in testcases):
+                return [ids[testcase] for testcase in testcases]
+        return TestCaseDictionary._intern(project_key, testcases)
+
+    @staticmethod
+    @ndb.transactional(retries=5)
+    def _intern(project_key, testcases):
+        dictionary = TestCaseDictionary.get_by_id(project_key.id())
+        if dictionary is None:
+            dictionary = TestCaseDictionary(id=project_key.id(), names=[])
+        ids = dictionary.ids()
+        known = len(dictionary.names)
+        result = []
+        for testcase in testcases:
+            if testcase not in ids:
+                ids[testcase] = len(dictionary.names)
+                dictionary.names.append(list(testcase if testcase[2] else testcase[:2]))
+            result.append(ids[testcase])
+        if len(dictionary.names) != known:
+            dictionary.put()
+        return result
+
+
 class JUnitTestResult(OCBaseModel):
     """
     A data model representing JUnit test results
@@ -268,11 +616,32 @@ class JUnitTestResult(OCBaseModel):
     push                = ndb.KeyProperty(Push)
     project             = ndb.KeyProperty(Project)
 
+    # Packed encoding of the testcases against the project's
+    # TestCaseDictionary, see encode_testsuite().  Results stored before
+    # this have testcases instead.
+    testcase_ids        = ndb.BlobProperty(compressed=True)     # id of each testcase, in order
+    outcomes            = ndb.BlobProperty(compressed=True)     # bitsets indexed by id
+    durations           = ndb.BlobProperty(compressed=True)     # float per id
+
     # A Travis job might restart etc so we may end up with duplicate
     # test results.  In this case, we'll query for travis builds with
     # the same job number and mark those results as invalid
     valid               = ndb.BooleanProperty()
 
+    def output_key(self, index):
+        return ndb.Key(JUnitTestOutput, index + 1, parent=self.key)
+
+    def get_output_async(self, index, has_output=True):
+        """
+        Future for the JUnitTestOutput of the index'th testcase, the result
+        is None if it had no text
+        """
+        if not has_output:
+            future = ndb.Future()
+            future.set_result(None)
+            return future
+        return self.output_key(index).get_async()
+
 
 
 class AlteraSynthResult(OCBaseModel):
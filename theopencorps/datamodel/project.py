@@ -22,13 +22,21 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import collections
+import hashlib
 import json
 import logging
-import time
+import re
 import StringIO
+import time
+import uuid
 
 import webapp2
 
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
 import theopencorps.paths as paths
 import pusher
 
@@ -36,7 +44,8 @@ import theopencorps.auth
 import theopencorps.travis.yml
 import theopencorps.corefile
 import theopencorps.secrets as config
-from theopencorps.datamodel.models import Project, Repository, User, JUnitTestResult, Push
+from theopencorps.datamodel.models import Project, Repository, User, JUnitTestResult, Push, \
+                                          PushAlias, EncryptedVariable
 
 from theopencorps.endpoints import HTTPException
 from theopencorps.endpoints.travis import TravisEndpoint
@@ -46,6 +55,84 @@ class ProjectError(Exception):
     pass
 
 
+# A stage of the project lifecycle, see ProjectHelper._steps
+Step = collections.namedtuple("Step", "name needed action countdown status")
+
+
+# Coordination of the project worker is done in memcache:
+#   lease:<name>        held while a worker is advancing the project
+#   rerun:<name>        somebody asked for another run while it was busy
+#   pending:<name>      an advance task has been enqueued but hasn't started
+#
+# Losing any of these only costs an extra run, the lease stops two workers
+# advancing the same project at once.
+_ADVANCE_NAMESPACE = "project.advance"
+_ADVANCE_LEASE = 10 * 60        # Longest a task can run for
+
+def _advance_task_name(full_name):
+    slug = re.sub(r"[^a-zA-Z0-9_-]", "_", full_name)[:400]
+    return "advance-%s-%s-%s" % (slug, hashlib.sha1(full_name).hexdigest()[:8],
+                                 uuid.uuid4().hex)
+
+def schedule_advance(full_name, countdown=None):
+    """
+    Make sure the project worker runs for full_name
+
+    At most one advance task is pending per project, enqueueing again before
+    it starts is a no-op.  If a worker is running right now we just ask it to
+    go round again once it's finished.
+    """
+    memcache.set("rerun:" + full_name, True, namespace=_ADVANCE_NAMESPACE)
+    if memcache.get("lease:" + full_name, namespace=_ADVANCE_NAMESPACE):
+        logging.debug("Worker for %s is running, it will go round again", full_name)
+        return
+
+    pending = "pending:" + full_name
+    if not memcache.add(pending, True, time=int(countdown or 0) + _ADVANCE_LEASE,
+                        namespace=_ADVANCE_NAMESPACE):
+        if memcache.get(pending, namespace=_ADVANCE_NAMESPACE):
+            logging.debug("Advance task for %s already pending", full_name)
+            return
+        # Memcache is unhappy, better a duplicate task than none at all
+        logging.warning("Unable to mark advance of %s as pending", full_name)
+    try:
+        taskqueue.add(url="/%s" % full_name,
+                      name=_advance_task_name(full_name),
+                      countdown=countdown)
+    except Exception:
+        memcache.delete(pending, namespace=_ADVANCE_NAMESPACE)
+        raise
+
+def begin_advance(full_name):
+    """
+    Called by the worker before advancing a project
+
+    Returns False if another worker already holds the lease, in which case
+    that worker is asked to go round again.  The caller should fail so the
+    task is retried, in case the holder died and the lease has to expire.
+    """
+    memcache.delete("pending:" + full_name, namespace=_ADVANCE_NAMESPACE)
+    if not memcache.add("lease:" + full_name, True, time=_ADVANCE_LEASE,
+                        namespace=_ADVANCE_NAMESPACE):
+        memcache.set("rerun:" + full_name, True, namespace=_ADVANCE_NAMESPACE)
+        return False
+    memcache.delete("rerun:" + full_name, namespace=_ADVANCE_NAMESPACE)
+    return True
+
+def end_advance(full_name, complete, countdown=None):
+    """
+    Called by the worker when it's done, releasing the lease
+
+    Schedules another run if there's more to do or if somebody asked for
+    one while we were busy
+    """
+    memcache.delete("lease:" + full_name, namespace=_ADVANCE_NAMESPACE)
+    if not complete:
+        schedule_advance(full_name, countdown=countdown)
+    elif memcache.get("rerun:" + full_name, namespace=_ADVANCE_NAMESPACE):
+        schedule_advance(full_name)
+
+
 class ProjectHelper(object):
 
     """
@@ -63,6 +150,31 @@ class ProjectHelper(object):
     _org = "OpenCorps"
     _shields = ["docs", "sim", "altera", "xilinx"]
 
+    # Seconds advance() may spend running steps before handing back
+    _budget = 15.0
+
+    # Project lifecycle, in order.  advance() runs the first step whose
+    # needed(project) is true.  countdown is how long to wait before retrying
+    # a failed step, or one that returned None because it's waiting on
+    # Github, status whether to push a status update "always", on "success"
+    # or "never".
+    _steps = [
+        Step("fork",            lambda p: not p.forked,
+             "create_fork",             0.5,    "success"),
+        Step("user_oc_yml",     lambda p: not p.user_oc_yml,
+             "_check_user_oc_step",     0.5,    "always"),
+        Step("merge",           lambda p: len(p.pending_merges),
+             "_merge_step",             0.5,    "never"),
+        Step("validate",        lambda p: not p.fork_yml_valid,
+             "_validate_step",          5.0,    "always"),
+        Step("travis_sync",     lambda p: not p.travis_sync_req,
+             "_sync_step",              0.5,    "never"),
+        Step("travis_webhook",  lambda p: not p.travis_webhook,
+             "enable_travis_webhook",   1.0,    "success"),
+        Step("travis_yml",      lambda p: not p.fork_travis_yml,
+             "create_travis_yml",       0.5,    "never"),
+    ]
+
     def __init__(self, project, repo=None):
         self.project = project
         if repo is None:
@@ -73,6 +185,7 @@ class ProjectHelper(object):
         self.oc_corefile = None
         self._updates = None
         self._template = None
+        self.countdown = None
 
 
     def update_sim_result(self, passed=0, failed=0, errors=0, skipped=0):
@@ -137,14 +250,15 @@ class ProjectHelper(object):
         """
         pass
 
-    def advance(self):
+    def advance(self, budget=None):
         """
         Do whatever is required on the project to advance the status.
 
-        Returns False if there is still more to do...
+        Runs the steps in _steps in order, doing as many as possible within
+        budget seconds (default _budget).  A failed step stops us, setting
+        self.countdown to how long the caller should wait before retrying.
 
-        FIXME: This should really be a bit nicer - state machine mapping to
-        function calls or something
+        Returns False if there is still more to do...
 
         NOTE: Callee needs to put() the updated project
 
@@ -157,65 +271,82 @@ class ProjectHelper(object):
             self.project.failure_count += 1
             raise ProjectError("Can't continue - no webhook for project")
 
-        if not self.project.forked:
-            if self.create_fork():
-                self.update_status()
-                self.project.failure_count = 0
-            else:
-                self.project.failure_count += 1
-            return False
+        deadline = time.time() + (self._budget if budget is None else budget)
+        self.countdown = None
 
-        if not self.project.user_oc_yml:
-            result = self.check_user_oc()
-            self.update_status()
-            if not result:
-                self.log.info("Waiting for a webhook on %s to indicate .opencorps.yml", self.repo.full_name)
-                self.project.failure_count += 1
-            else:
-                self.project.failure_count = 0
-            return False
+        while True:
+            # Nothing more we can do until the user fixes their .opencorps.yml
+            if self.project.fork_yml_invalid and not self.project.pending_merges:
+                return True
 
-        # Perform any pending_merges in case the user has update YML file
-        # Note in theory we should check whether .opencorps.yml has changed
-        # however for now we'll just always regenerate but only commit if
-        # the .travis.yml turns out different
-        if len(self.project.pending_merges):
-            self.project.fork_yml_valid = False
-            self.project.fork_yml_invalid = False
-            self.project.fork_travis_yml = False
-            if not self.apply_pending_merge():
-                self.project.failure_count += 1
+            for step in self._steps:
+                if step.needed(self.project):
+                    break
             else:
                 self.project.failure_count = 0
-            return False
-
-        if not self.project.fork_yml_valid:
-            self.validate_oc_yml()
-            self.update_status()
-            return self.project.fork_yml_invalid
+                self.project.init_complete = True
+                self.update_status()
+                return True
 
-        if not self.project.travis_sync_req:
-            self.travis.sync(block=False)
-            self.project.travis_sync_req = True
-            self.project.failure_count = 0
-            return False
+            if time.time() > deadline:
+                self.log.info("Out of time, continuing with %s next time", step.name)
+                return False
 
-        if not self.project.travis_webhook:
-            if not self.enable_travis_webhook():
-                self.project.failure_count += 1
-            else:
-                self.project.failure_count = 0
+            self.log.info("Running step %s", step.name)
+            success = getattr(self, step.action)()
+            if step.status == "always" or (success and step.status == "success"):
                 self.update_status()
-            return False
 
-        if not self.project.fork_travis_yml:
-            if not self.create_travis_yml():
+            if success is None:
+                self.log.info("Step %s is waiting, retrying in %.1fs", step.name, step.countdown)
+                self.countdown = step.countdown
+                return False
+            if not success:
+                self.log.info("Step %s failed, retrying in %.1fs", step.name, step.countdown)
                 self.project.failure_count += 1
+                self.countdown = step.countdown
                 return False
+            self.project.failure_count = 0
+
 
-        self.project.failure_count = 0
-        self.project.init_complete = True
-        self.update_status()
+    def _merge_step(self):
+        """
+        Perform any pending_merges in case the user has update YML file
+
+        Note in theory we should check whether .opencorps.yml has changed
+        however for now we'll just always regenerate but only commit if
+        the .travis.yml turns out different
+        """
+        self.project.fork_yml_valid = False
+        self.project.fork_yml_invalid = False
+        self.project.fork_travis_yml = False
+        return self.apply_pending_merge()
+
+
+    def _validate_step(self):
+        """
+        Succeeds if we reached a verdict, even if that's "invalid"
+
+        Forks are created asynchronously, so until .opencorps.yml shows up
+        in ours we're waiting rather than failing
+        """
+        if self.oc_yml is None:
+            self.log.info("No .opencorps.yml in %s/%s yet", self._org, self.repo.name)
+            return None
+        self.validate_oc_yml()
+        return self.project.fork_yml_valid or self.project.fork_yml_invalid
+
+
+    def _sync_step(self):
+        self.travis.sync(block=False)
+        self.project.travis_sync_req = True
+        return True
+
+
+    def _check_user_oc_step(self):
+        if not self.check_user_oc():
+            self.log.info("Waiting for a webhook on %s to indicate .opencorps.yml", self.repo.full_name)
+            return False
         return True
 
 
@@ -325,43 +456,45 @@ class ProjectHelper(object):
         """
         Enable travis webhook for our fork
         """
-        if not self.travis.is_synced():
-            self.log.info("Still waiting for travis to synchronise")
-            # Give travis some time before hammering again...
-            time.sleep(0.1)
+        synced, hooks, repo = self.travis.get_hook_state(self._org, self.repo.name)
+        if not synced:
+            # The failure means we're re-queued with a countdown, giving
+            # travis some time before hammering again
             return False
 
-        hooks = self.travis.get_hooks()
-        repo = self.travis.get_repo(self._org, self.repo.name)
-
-        if not hooks:
-            logging.error("Failed to get travis hooks, giving up")
+        if not repo:
+            logging.error("Failed to get travis repo, giving up")
             return False
 
-        for hook_d in hooks['hooks']:
-            if hook_d['name'] == self.repo.name and \
-                                hook_d['owner_name'] == self._org:
-                hook_id = hook_d['id']
-                logging.info("Found travis hook ID %s", repr(hook_id))
-                break
-        else:
-            self.log.error("Couldn't find a matching travis hook")
+        try:
+            for hook_d in hooks:
+                if hook_d['name'] == self.repo.name and \
+                                    hook_d['owner_name'] == self._org:
+                    hook_id = hook_d['id']
+                    logging.info("Found travis hook ID %s", repr(hook_id))
+                    break
+            else:
+                self.log.error("Couldn't find a matching travis hook")
+                return False
+        except HTTPException as e:
+            logging.error("Failed to get travis hooks, giving up (%s)", repr(e))
             return False
 
         if hook_d['active']:
             self.log.info("Travis hook for %s/%s already enabled", 'OpenCorps', self.repo.name)
+            hook_id = None
         else:
             self.log.info('Enabling travis hook for %s/%s', 'OpenCorps', self.repo.name)
-            self.travis.enable_hook(int(hook_id))
+            hook_id = int(hook_id)
 
         # Fix up Travis shonky API
         repo = repo["repo"]
         repo_id = repo["id"]
 
-        if not self.travis.update_settings(repo_id,
-                                           builds_only_with_travis_yml=True,
-                                           build_pushes=True,
-                                           build_pull_requests=False):
+        if not self.travis.configure_repo(repo_id, hook_id=hook_id,
+                                          builds_only_with_travis_yml=True,
+                                          build_pushes=True,
+                                          build_pull_requests=False):
             self.log.warning("Didn't manage to update Travis settings for repo %d", repo_id)
         else:
             self.log.info("Updated Travis settings for %s/%s (%d)", self._org, self.repo.name, repo_id)
@@ -371,21 +504,53 @@ class ProjectHelper(object):
 
 
 
+    def encrypt_variables(self, variables):
+        """
+        Encrypt variables with the Travis key of our fork
+
+        Ciphertext is remembered in the datastore, so unless the key or a
+        variable changes we don't do any RSA and get identical output
+        """
+        fingerprint, _ = self.travis.get_public_key(self._org, self.repo.name)
+        keys = [ndb.Key(EncryptedVariable, EncryptedVariable.digest(fingerprint, variable))
+                                                            for variable in variables]
+        encrypted = []
+        new = []
+        for key, variable, stored in zip(keys, variables, ndb.get_multi(keys)):
+            if stored is None:
+                stored = EncryptedVariable(key=key, fingerprint=fingerprint,
+                                           ciphertext=self.travis.encrypt(self._org,
+                                                                          self.repo.name,
+                                                                          variable))
+                new.append(stored)
+            encrypted.append(stored.ciphertext)
+        if new:
+            ndb.put_multi_async(new)
+        self.log.info("Encrypted %d secure variables (%d not seen before)",
+                      len(variables), len(new))
+        return encrypted
+
+
     def create_travis_yml(self):
         """
         Create a .travis.yml file in our fork of the repository
         """
+        # Fetch the current state of the fork in one round-trip
+        filenames = [".travis.yml"]
         if self.oc_corefile is None:
-            self.validate_oc_yml()
+            filenames.append(".opencorps.yml")
+        contents = self.gh_oc.get_files(self._org, self.repo.name, filenames)
+        self.travis_yml = contents[0]
+        if self.oc_corefile is None:
+            self.oc_yml = contents[1]
+            if not self.validate_oc_yml():
+                return False
 
         self.log.info("Creating a .travis.yml file for %s", self.project.full_name)
 
         # Encrypt environment variables
         token = "'MSG_TOKEN=%s'" % self.project.secret
-        secure_variables = []
-        for variable in config.secure_variables + [token]:
-            secure_variables.append(self.travis.encrypt('OpenCorps', self.repo.name, variable))
-            self.log.info("%s -> %s", variable, secure_variables[-1])
+        secure_variables = self.encrypt_variables(config.secure_variables + [token])
 
         namespace = self.oc_corefile.to_template_dict()
         if "environment_variables" not in namespace:
@@ -403,25 +568,7 @@ class ProjectHelper(object):
         contents = theopencorps.travis.yml.TravisYML(**namespace).render()
         self.log.debug(contents)
 
-        def thesame(one, tother):
-            """
-            Custom compare function to skip secure variables, since they change
-            """
-            one = one.split('\n')
-            tother = tother.split('\n')
-            for lineno, line in enumerate(one):
-                if lineno >= len(tother):
-                    return False
-                if line.strip().startswith("- secure:"):
-                    continue
-                if line != tother[lineno]:
-                    return False
-            return True
-
-
-        if self.travis_yml is None or not thesame(self.travis_yml, contents):
-
-            before = self.gh_oc.get_head(self._org, self.repo.name)
+        if self.travis_yml != contents:
 
             if self.travis_yml is None:
                 self.log.info("Creating new .travis.yml in the repository")
@@ -429,21 +576,24 @@ class ProjectHelper(object):
             else:
                 self.log.info(".travis.yml has changed, updating %s", self.project.full_name)
                 message = "Updating .travis.yml from .opencorps.yml"
-            success = self.gh_oc.commit_file(self._org, self.repo.name,
-                                   ".travis.yml", contents, message)
-            self.project.fork_travis_yml = success
-            if not success:
-                self.log.error("Something when wrong committing .travis.yml")
-                after = None
-            else:
+            try:
+                before, after = self.gh_oc.commit_files(self._org, self.repo.name,
+                                                        {".travis.yml": contents},
+                                                        message)
                 self.log.info(".travis.yml updated successfully")
-                after = self.gh_oc.get_head(self._org, self.repo.name)
+            except HTTPException as e:
+                self.log.error("Something when wrong committing .travis.yml: %s", repr(e))
+                before = after = None
+            self.project.fork_travis_yml = after is not None
 
             # Write back the update
             if after is not None:
 
                 # First see if the before sha is just an upstream commit
-                push = Push.get_by_id(before)
+                push, alias = ndb.get_multi([ndb.Key(Push, before),
+                                             ndb.Key(PushAlias, before)])
+                if push is None and alias is not None:
+                    push = alias.push.get()
 
                 if push is None:
                     push = Push.query(Push.fork_merge == before).fetch(1)
@@ -453,6 +603,7 @@ class ProjectHelper(object):
                 if push:
                     push.travis_update = after
                     push.put_async()
+                    PushAlias.record_async(after, push)
 
                 # Tell travis to build this
                 self.travis.sync(block=False)
@@ -468,13 +619,35 @@ class ProjectHelper(object):
         Upstream changed, so we need to apply the fork to our
         repository.
 
+        All pending pushes to the same ref as the oldest one are coalesced
+        into a single update to the newest of them, so a burst of pushes
+        settles in one step (and Travis doesn't build every intermediate
+        commit).  Every covered Push records the resulting fork commit.
+
         TODO: Regenerate .travis.yml if any dependent files were changed
         in any of the commits.
         """
-        push = self.project.pending_merges[0].get()
-        sha1 = push.after
+        keys = self.project.pending_merges
+        pushes = ndb.get_multi(keys)
+
+        missing = [key for key, push in zip(keys, pushes) if push is None]
+        if missing:
+            self.log.warning("Dropping %d pending merges with no Push: %s",
+                             len(missing), repr(missing))
+            self.project.pending_merges = [key for key in keys if key not in missing]
+            pushes = [push for push in pushes if push is not None]
+            if not pushes:
+                return True
+
+        ref = pushes[0].ref
+        covered = [push for push in pushes if push.ref == ref]
+        sha1 = covered[-1].after
         commit = ""
 
+        if len(covered) > 1:
+            self.log.info("Coalescing %d pushes to %s, merging up to %s",
+                          len(covered), ref, sha1)
+
         # First of all attempt to cherry-pick, thus avoiding polluting history
         self.log.info("Attempting to cherry-pick upstream changeset %s", sha1)
         try:
@@ -489,16 +662,19 @@ class ProjectHelper(object):
             except HTTPException as e:
                 self.log.error("Failed to merge upstream changeset %s", sha1)
                 self.log.debug(repr(e))
-            return False
+                return False
+
+        done = set(push.key for push in covered)
+        self.project.pending_merges = [key for key in self.project.pending_merges
+                                                        if key not in done]
 
         if not len(commit):
+            # e.g. the merge was a no-op, nothing new for Travis to build
             self.log.warning("Didn't get an sha1 for cherry-picked commit?")
-        else:
-            self.project.pending_merges.pop(0)
-            # Tell travis to build this commit
-
+            return True
 
-        push.fork_merge = commit
-        push.put_async()
+        for push in covered:
+            push.fork_merge = commit
+        ndb.put_multi_async(covered)
+        PushAlias.record_async(commit, covered[-1])
         return True
-
@@ -29,29 +29,308 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import functools
+import hashlib
 import json
 import logging
+import random
+import re
+import threading
+import time
 
-from google.appengine.api import urlfetch
+# memcache is only used as an optional shared cache tier, so the endpoints
+# can still be used outside of GAE
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+from theopencorps.endpoints.ratelimit import RateLimiter
+from theopencorps.endpoints.transport import Headers, TransportError, URLFetchTransport
 
 _MY_APP = 'TheOpenCorps/1.0.0'
 
+_LINK_RE = re.compile(r'<([^>]+)>\s*;\s*rel="([^"]+)"')
+
 class HTTPException(Exception):
     """Base class for all HTTP related exceptions"""
     pass
 
-class cache(object):    # pylint: disable=invalid-name
+class RateLimited(Exception):
+    """
+    Sending the request now would exceed the rate limit
+
+    retry_after is the number of seconds the work should be deferred by.
+    Deliberately not an HTTPException so handlers of failed requests don't
+    swallow it, it should propagate up to whoever can defer the work.
+    """
+    def __init__(self, retry_after, *args):
+        Exception.__init__(self, "Rate limited, retry after %.1fs" % retry_after, *args)
+        self.retry_after = retry_after
+
+
+class LRUCache(object):
+    """
+    Bounded, thread-safe mapping that evicts the least recently used entry
+    """
+    _missing = object()
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.pop(key, self._missing)
+            if value is self._missing:
+                return default
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_CacheEntry = collections.namedtuple("_CacheEntry", "etag last_modified content headers")
+
+class ResponseCache(object):
     """
-    Decorator to memoise return value (no kword args)
+    Conditional request cache
+
+    We remember the ETag / Last-Modified validators of successful GETs, keyed
+    on (token, method, URL), so that subsequent requests can be revalidated
+    with If-None-Match / If-Modified-Since.  GitHub doesn't count a 304
+    against the rate limit and we don't have to download the body again.
+
+    Entries live in a bounded in-process LRU and, if shared is set, in
+    memcache so that all instances benefit.
+
+    A 304 doesn't repeat headers describing the body, so we keep those
+    that callers rely on (e.g. Link for pagination) alongside it.
     """
-    def __init__(self, func):
-        self._func = func
-        self.memo = {}
+    _headers = ("Link", "Content-Type")
 
-    def __call__(self, *args):
-        if args not in self.memo:
-            self.memo[args] = self._func(*args)
-        return self.memo[args]
+    def __init__(self, maxsize=256, shared=True, namespace="endpoints.etag.v2"):
+        self._local = LRUCache(maxsize)
+        self.shared = shared and memcache is not None
+        self.namespace = namespace
+
+    @staticmethod
+    def key(token, method, url):
+        """
+        Tokens must not leak into memcache keys, so hash everything
+        """
+        return hashlib.sha1("%s %s %s" % (token, method, url)).hexdigest()
+
+    def get(self, key):
+        entry = self._local.get(key)
+        if entry is None and self.shared:
+            entry = memcache.get(key, namespace=self.namespace)
+            if entry is not None:
+                self._local.put(key, entry)
+        return entry
+
+    def store(self, key, response):
+        """
+        Remember a response if it carries a validator
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        headers = dict((name, response.headers.get(name)) for name in self._headers
+                       if response.headers.get(name) is not None)
+        entry = _CacheEntry(etag, last_modified, response.content, headers)
+        self._local.put(key, entry)
+        if self.shared:
+            try:
+                memcache.set(key, entry, namespace=self.namespace)
+            except ValueError:
+                # Value too large for memcache, the local tier will do
+                pass
+
+    def discard(self, key):
+        self._local.discard(key)
+        if self.shared:
+            memcache.delete(key, namespace=self.namespace)
+
+
+class CachedResponse(object):
+    """
+    Stands in for a transport response when the body came from the cache
+    """
+    def __init__(self, content, headers=None, status_code=200):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {}
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed request is worth repeating and how long to wait
+
+        statuses    dict mapping status code to IDEMPOTENT (retry only if the
+                    request is safe to repeat) or ALWAYS (the server tells us
+                    it didn't act on the request)
+        attempts    maximum number of attempts, including the first
+        base        initial backoff in seconds, doubled on every attempt
+        cap         longest single backoff in seconds
+        deadline    seconds after which we stop trying altogether
+        idempotent  methods that are safe to repeat
+
+    Delays use "full jitter" so a burst of tasks doesn't retry in lockstep.
+    A request that never got a response is treated like an IDEMPOTENT status.
+    """
+    IDEMPOTENT = "idempotent"
+    ALWAYS = "always"
+
+    _default_statuses = {
+        429: ALWAYS,
+        500: IDEMPOTENT,
+        502: IDEMPOTENT,
+        503: IDEMPOTENT,
+        504: IDEMPOTENT,
+    }
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, statuses=None, attempts=4, base=0.1, cap=2.0,
+                 deadline=10.0, idempotent=("GET", "HEAD", "PUT", "DELETE", "OPTIONS")):
+        self.statuses = dict(self._default_statuses)
+        if statuses is not None:
+            self.statuses.update(statuses)
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.idempotent = idempotent
+
+    def backoff(self, start=None):
+        """
+        Generator of delays before each retry, stops when we should give up
+
+        start is when the first attempt was made, the deadline covers it too
+        """
+        if start is None:
+            start = time.time()
+        for attempt in range(1, self.attempts):
+            delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+            if time.time() + delay - start > self.deadline:
+                return
+            yield delay
+
+    def should_retry(self, method, status_code=None, idempotent=None):
+        """
+        status_code is None if we didn't get a response at all
+
+        idempotent overrides our view of whether method is safe to repeat
+        """
+        if idempotent is None:
+            idempotent = method in self.idempotent
+        if status_code is None:
+            return idempotent
+        rule = self.statuses.get(status_code)
+        if rule == self.ALWAYS:
+            return True
+        if rule == self.IDEMPOTENT:
+            return idempotent
+        return False
+
+
+class memoize(object):    # pylint: disable=invalid-name
+    """
+    Decorator to memoise the return value of an endpoint method
+
+        ttl         (float) seconds before an entry is refetched, None for never
+        maxsize     (int)   entries kept before the least recently used is evicted
+        per_token   (bool)  key on the endpoint token rather than the instance
+
+    Keying on the token means a fresh endpoint created for every request
+    still hits the cache, and we don't hold on to instances forever.
+
+    Only one thread fills a given entry, anybody else asking for the same key
+    waits for that result rather than making a duplicate request.
+    """
+    def __init__(self, ttl=None, maxsize=128, per_token=True):
+        self.ttl = ttl
+        self.per_token = per_token
+        self.hits = 0
+        self.misses = 0
+        self._entries = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self._filling = {}
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def _wrapper(instance, *args):
+            return self.lookup(func, instance, *args)
+        _wrapper.memo = self
+        return _wrapper
+
+    def _key(self, func, instance, args):
+        if self.per_token:
+            owner = (instance.__class__.__name__, instance.token)
+        else:
+            owner = id(instance)
+        return (func.__name__, owner) + args
+
+    def _cached(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires, value = entry
+        if expires is not None and expires < time.time():
+            self._entries.discard(key)
+            return False, None
+        return True, value
+
+    def lookup(self, func, instance, *args):
+        key = self._key(func, instance, args)
+        found, value = self._cached(key)
+        if found:
+            self.hits += 1
+            return value
+
+        with self._lock:
+            fill_lock = self._filling.setdefault(key, threading.Lock())
+        try:
+            with fill_lock:
+                # Somebody may have filled this while we were waiting
+                found, value = self._cached(key)
+                if found:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+                value = func(instance, *args)
+                expires = time.time() + self.ttl if self.ttl is not None else None
+                self._entries.put(key, (expires, value))
+                return value
+        finally:
+            with self._lock:
+                if self._filling.get(key) is fill_lock:
+                    del self._filling[key]
+
+    def invalidate(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "maxsize": self._entries.maxsize}
 
 def auth(method):
     """
@@ -68,15 +347,19 @@ class ASyncResult(object):
     """
     Convenience mechanism for un-wrapping an RPC
     """
-    def __init__(self, rpc, log, valid_codes=(200,)):
+    def __init__(self, rpc, log, valid_codes=(200,), finish=None):
         self.rpc = rpc
         self.log = log
         self.valid_codes = valid_codes
+        self.finish = finish
 
     def get_result(self):
         try:
-            result = self.rpc.get_result()
-        except urlfetch.DownloadError as e:
+            if self.finish is not None:
+                result = self.finish(self.rpc)
+            else:
+                result = self.rpc.get_result()
+        except TransportError as e:
             self.log.error("Failed to retrieve %s (%s)", self.rpc.msg, repr(e))
             return None
 
@@ -146,8 +429,28 @@ class APIEndpointBase(object):
     _endpoint = ""
     _accept = ""
 
-    def __init__(self):
+    # Used unless a transport is passed to the constructor
+    _default_transport = URLFetchTransport()
+
+    # Default limit on concurrent RPCs issued by request_many
+    _max_in_flight = 8
+
+    # Shared by all instances, entries are keyed by token so nobody gets
+    # to see somebody else's responses.  Set to None to disable.
+    _response_cache = ResponseCache()
+
+    # Quota tracking per token.  Requests are delayed by up to _max_rate_wait
+    # seconds to stay within the limit, beyond that we raise RateLimited so
+    # the caller can defer the work.
+    _rate_limiter = RateLimiter()
+    _max_rate_wait = 1.0
+
+    # Applied to every request unless overridden per call, None to disable
+    _retry_policy = RetryPolicy()
+
+    def __init__(self, transport=None):
         self._token = None
+        self._transport = transport if transport is not None else self._default_transport
         self.log = logging.getLogger(self.__class__.__name__)
 
     @property
@@ -162,6 +465,30 @@ class APIEndpointBase(object):
                            repr(self._token), repr(token))
         self._token = token
 
+    @property
+    def budget(self):
+        """
+        What we know about the remaining rate limit quota for our token
+        """
+        if self._rate_limiter is None:
+            return None
+        return self._rate_limiter.budget(self._token)
+
+    def _throttle(self):
+        """
+        Wait for a slot within the rate limit, raise RateLimited if that
+        would take too long
+        """
+        if self._rate_limiter is None:
+            return
+        granted, wait = self._rate_limiter.reserve(self._token, self._max_rate_wait)
+        if not granted:
+            self.log.warning("Rate limit reached, deferring for %.1fs", wait)
+            raise RateLimited(wait)
+        if wait > 0:
+            self.log.info("Pacing request by %.2fs to stay within rate limit", wait)
+            time.sleep(wait)
+
     # pylint: disable=too-many-arguments
     def _create_request_args(self, payload=None,
                                    method="GET",
@@ -201,21 +528,57 @@ class APIEndpointBase(object):
             request_args['headers']["Content-Type"] = "application/json"
         return request_args
 
-    def request(self, resource, **kwargs):
+    def _conditional(self, resource, request_args):
         """
-        Convenience for making requests
+        Add cache validators to the request if we've seen this GET before
 
-        Synchronous returns an object with status_code and content members.
-
-        FIXME this should really return JSON to match ASync
+        Returns a (key, entry) tuple for _revalidated, either may be None
         """
-        request_args = self._create_request_args(**kwargs)
-        result = urlfetch.fetch(self._endpoint + resource, **request_args)
-
-        msg = "%s: %s%s %d (returned %d bytes)" % (
-            request_args["method"], self._endpoint, resource,
-            result.status_code, len(result.content))
+        if self._response_cache is None:
+            return None, None
+        if request_args["method"] != "GET" or request_args["payload"] is not None:
+            return None, None
+        key = self._response_cache.key(self._token, request_args["method"],
+                                       self._endpoint + resource)
+        entry = self._response_cache.get(key)
+        if entry is not None:
+            headers = request_args["headers"]
+            if entry.etag and "If-None-Match" not in headers:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified and "If-Modified-Since" not in headers:
+                headers["If-Modified-Since"] = entry.last_modified
+        return key, entry
+
+    def _revalidated(self, key, entry, result):
+        """
+        Serve the cached body on a 304, otherwise remember the response
+        """
+        if key is None:
+            return result
+        if result.status_code == 304 and entry is not None:
+            self.log.debug("Not modified, serving %d cached bytes", len(entry.content))
+            headers = Headers(result.headers.items())
+            for name, value in entry.headers.items():
+                if name not in headers:
+                    headers[name] = value
+            return CachedResponse(entry.content, headers=headers)
+        if result.status_code == 200:
+            self._response_cache.store(key, result)
+        return result
 
+    def _completion(self, key, entry):
+        """
+        Returns a callable to post-process a response to our request
+        """
+        def _complete(result):
+            if self._rate_limiter is not None:
+                self._rate_limiter.update(self._token, result.headers)
+            return self._revalidated(key, entry, result)
+        return _complete
+
+    def _log_response(self, msg, request_args, result):
+        msg = "%s %d (returned %d bytes)" % (msg, result.status_code,
+                                             len(result.content))
         if result.status_code == 200:
             self.log.info(msg)
             self.log.debug("Sent: %s", repr(request_args["headers"]))
@@ -226,6 +589,76 @@ class APIEndpointBase(object):
             self.log.info("Sent %s", repr(request_args["headers"]))
             self.log.debug("payload: %s", repr(request_args["payload"]))
             self.log.info(result.content)
+
+    def _start(self, resource, retry=None, idempotent=None, **kwargs):
+        """
+        Kick off a call for resource on our transport
+
+            retry       RetryPolicy to use instead of _retry_policy
+            idempotent  override whether the policy treats this as safe to repeat
+
+        The call carries everything needed to finish the request off later
+        """
+        request_args = self._create_request_args(**kwargs)
+        key, entry = self._conditional(resource, request_args)
+        self._throttle()
+        started = time.time()
+        rpc = self._transport.start(self._endpoint + resource, **request_args)
+        rpc.msg = "%s: %s%s" % (request_args["method"],
+                                self._endpoint,
+                                resource)
+        rpc.request_args = request_args
+        rpc.complete = self._completion(key, entry)
+        rpc.restart = lambda: self._start(resource, retry=retry,
+                                          idempotent=idempotent, **kwargs)
+        rpc.policy = self._retry_policy if retry is None else retry
+        rpc.idempotent = idempotent
+        rpc.delays = rpc.policy.backoff(started) if rpc.policy is not None else iter(())
+        return rpc
+
+    def _finish(self, rpc):
+        """
+        Wait for a call created by _start and post-process the response
+
+        Retryable failures are re-issued according to the retry policy.
+        Raises TransportError if we never got a response.
+        """
+        while True:
+            try:
+                result = rpc.get_result()
+                error, status = None, result.status_code
+            except TransportError as e:
+                result, error, status = None, e, None
+
+            if rpc.policy is not None and \
+                    rpc.policy.should_retry(rpc.request_args["method"], status,
+                                            rpc.idempotent):
+                delay = next(rpc.delays, None)
+                if delay is not None:
+                    self.log.warning("%s %s, retrying in %.2fs", rpc.msg,
+                                     repr(error) if error else status, delay)
+                    time.sleep(delay)
+                    delays = rpc.delays
+                    rpc = rpc.restart()
+                    rpc.delays = delays
+                    continue
+                self.log.warning("%s giving up after retries", rpc.msg)
+
+            if error is not None:
+                raise error
+            return rpc.complete(result)
+
+    def request(self, resource, **kwargs):
+        """
+        Convenience for making requests
+
+        Synchronous returns an object with status_code and content members.
+
+        FIXME this should really return JSON to match ASync
+        """
+        rpc = self._start(resource, **kwargs)
+        result = self._finish(rpc)
+        self._log_response(rpc.msg, rpc.request_args, result)
         return result
 
 
@@ -236,23 +669,102 @@ class APIEndpointBase(object):
         Returns ASyncResult object, for which the JSON can
         be retrieved in the future using get_result()
         """
-        request_args = self._create_request_args(**kwargs)
-        rpc = urlfetch.create_rpc()
-        rpc.msg = "%s: %s%s" % (request_args["method"],
-                                self._endpoint,
-                                resource)
-        urlfetch.make_fetch_call(rpc, self._endpoint + resource, **request_args)
-        return ASyncResult(rpc, self.log)
+        return ASyncResult(self._start(resource, **kwargs), self.log,
+                           finish=self._finish)
 
 
     def request_json(self, resource, valid_codes=(200,), **kwargs):
         """
         Returns a JSON-like object which is actually a future...
         """
-        request_args = self._create_request_args(**kwargs)
-        rpc = urlfetch.create_rpc()
-        rpc.msg = "%s: %s%s" % (request_args["method"],
-                                self._endpoint,
-                                resource)
-        urlfetch.make_fetch_call(rpc, self._endpoint+resource, **request_args)
-        return ASyncJSONObject(rpc, self.log, valid_codes=valid_codes)
+        return ASyncJSONObject(self._start(resource, **kwargs), self.log,
+                               valid_codes=valid_codes, finish=self._finish)
+
+
+    def request_many(self, resources, max_in_flight=None):
+        """
+        Issue a batch of requests in parallel
+
+            resources       list of resources, each either a string or a
+                            (resource, kwargs) tuple of arguments to request()
+            max_in_flight   limit on outstanding RPCs (default _max_in_flight)
+
+        Returns a list of responses in the same order as resources.  If a
+        request couldn't be completed its entry is an HTTPException (or
+        RateLimited) instead, so one failure doesn't lose the rest of the batch.
+        """
+        if max_in_flight is None:
+            max_in_flight = self._max_in_flight
+
+        results = [None] * len(resources)
+        pending = collections.deque(enumerate(resources))
+        in_flight = {}
+
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                index, item = pending.popleft()
+                if isinstance(item, basestring):
+                    resource, kwargs = item, {}
+                else:
+                    resource, kwargs = item
+                try:
+                    in_flight[self._start(resource, **kwargs)] = index
+                except RateLimited as e:
+                    results[index] = e
+            if not in_flight:
+                break
+
+            rpc = self._transport.wait_any(in_flight.keys())
+            index = in_flight.pop(rpc)
+            try:
+                result = self._finish(rpc)
+            except RateLimited as e:
+                results[index] = e
+                continue
+            except TransportError as e:
+                self.log.error("Failed to retrieve %s (%s)", rpc.msg, repr(e))
+                results[index] = HTTPException("%s failed: %s" % (rpc.msg, repr(e)))
+                continue
+            self._log_response(rpc.msg, rpc.request_args, result)
+            results[index] = result
+        return results
+
+
+    def paginate(self, resource, items_key=None, per_page=None, **kwargs):
+        """
+        Iterate over every item of a paginated list resource
+
+            items_key   if the list is wrapped in an object, the key holding it
+            per_page    page size to request, None for the server default
+
+        Pages are found by following the Link: rel="next" header.  The first
+        page is requested immediately and each following page is requested
+        before we start handing out the items of the current one, so the
+        caller rarely waits.  Stop iterating to avoid fetching the rest.
+        """
+        if per_page is not None:
+            separator = "&" if "?" in resource else "?"
+            resource = "%s%sper_page=%d" % (resource, separator, per_page)
+        return self._pages(self._start(resource, **kwargs), items_key, kwargs)
+
+    def _pages(self, rpc, items_key, kwargs):
+        while rpc is not None:
+            result = self._finish(rpc)
+            self._log_response(rpc.msg, rpc.request_args, result)
+            if result.status_code != 200:
+                raise HTTPException("%s returned %d", rpc.msg, result.status_code)
+
+            rpc = None
+            links = dict((rel, url) for url, rel in
+                         _LINK_RE.findall(result.headers.get("Link", "")))
+            if "next" in links:
+                if links["next"].startswith(self._endpoint):
+                    rpc = self._start(links["next"][len(self._endpoint):], **kwargs)
+                else:
+                    self.log.error("Not following next page to %s", links["next"])
+
+            items = json.loads(result.content)
+            if items_key is not None:
+                items = items[items_key]
+            for item in items:
+                yield item
@@ -26,7 +26,7 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 import base64
 import json
 
-from theopencorps.endpoints import APIEndpointBase, HTTPException, cache
+from theopencorps.endpoints import APIEndpointBase, HTTPException, RateLimited, memoize
 
 
 class GithubEndpoint(APIEndpointBase):
@@ -34,31 +34,39 @@ class GithubEndpoint(APIEndpointBase):
     _endpoint = "https://api.github.com"
     _accept = "application/vnd.github.v3+json"
 
-    def __init__(self, token=None):
-        APIEndpointBase.__init__(self)
+    def __init__(self, token=None, transport=None):
+        APIEndpointBase.__init__(self, transport=transport)
         self.token = token
         self.log.info("Created endpoint with token %s", repr(token))
 
     @property
-    @cache
+    @memoize(ttl=600, maxsize=256)
     def user(self):
         """
         Get the currently logged in user
         """
-        return json.loads(self.request("/user").content)
+        response = self.request("/user")
+        if response.status_code != 200:
+            # Raise rather than memoising the error response
+            raise HTTPException("Attempt to retrieve user returned %d (%s)",
+                                response.status_code, response.content)
+        return json.loads(response.content)
 
 
     def get_repos(self):
+        """
+        Iterate over the repositories of the currently logged in user
+        """
         username = self.user["login"]
         self.log.info("Fetching repos for %s", username)
-        return json.loads(self.request("/users/%s/repos" % username).content)
+        return self.paginate("/users/%s/repos" % username, per_page=100)
 
-    def get_repo_async(self, user, repo):
-        return self.request_async("/repos/%s/%s" % (user, repo))
+    def get_repo_async(self, user, repo, retry=None):
+        return self.request_async("/repos/%s/%s" % (user, repo), retry=retry)
 
 
-    def get_repo(self, user, repo):
-        response = self.request("/repos/%s/%s" % (user, repo))
+    def get_repo(self, user, repo, retry=None):
+        response = self.request("/repos/%s/%s" % (user, repo), retry=retry)
         if response.status_code != 200:
             raise HTTPException("Attempt to retrieverepo info  %s/%s returned %d (%s)",
                                 user, repo,
@@ -66,15 +74,19 @@ class GithubEndpoint(APIEndpointBase):
         return json.loads(response.content)
 
 
+    @staticmethod
+    def _decode_file(response):
+        response = json.loads(response.content)
+        assert response['encoding'] == "base64"
+        return base64.b64decode(response['content'])
+
     def get_file(self, user, repo, path):
         response = self.request("/repos/%s/%s/contents/%s" % (user, repo, path))
         if response.status_code != 200:
             raise HTTPException("Attempt to retrieve %s/%s/%s returned %d (%s)",
                                 user, repo, path,
                                 response.status_code, response.content)
-        response = json.loads(response.content)
-        assert response['encoding'] == "base64"
-        return base64.b64decode(response['content'])
+        return self._decode_file(response)
 
 
     def fork(self, user, repo, organisation="", block=True):
@@ -147,6 +159,90 @@ class GithubEndpoint(APIEndpointBase):
         current = json.loads(response.content)
         return current["object"]["sha"]
 
+    def get_files(self, user, repo, paths, branch='master'):
+        """
+        Retrieve several files in parallel
+
+        Returns a list of contents where any entry is None if it couldn't
+        be retrieved
+        """
+        responses = self.request_many(
+            ["/repos/%s/%s/contents/%s?ref=%s" % (user, repo, path, branch)
+                                                            for path in paths])
+        decoded = []
+        for response in responses:
+            if isinstance(response, RateLimited):
+                raise response
+            if isinstance(response, HTTPException) or response.status_code != 200:
+                decoded.append(None)
+            else:
+                decoded.append(self._decode_file(response))
+        return decoded
+
+    # pylint: disable=too-many-arguments
+    def commit_files(self, user, repo, files, message, branch='master'):
+        """
+        Commit several files in a single commit using the Git Data API
+            files       (dict)  path -> file contents
+            message     (str)   commit message
+
+        Builds one tree and one commit on top of the tip of branch, then moves
+        the ref.  The ref isn't forced so if somebody else pushed in the
+        meantime nothing changes and we raise.
+
+        Returns (parent, sha1) of the new commit
+        """
+        # Gives us both the tip of the branch and its tree
+        response = self.request("/repos/%s/%s/commits/%s" % (user, repo, branch))
+        if response.status_code != 200:
+            raise HTTPException("Attempt to find head of %s/%s:%s returned %d (%s)",
+                                user, repo, branch,
+                                response.status_code, response.content)
+        head = json.loads(response.content)
+        parent = head["sha"]
+
+        tree = [{"path"     : path,
+                 "mode"     : "100644",
+                 "type"     : "blob",
+                 "content"  : content} for path, content in sorted(files.iteritems())]
+        response = self.request("/repos/%s/%s/git/trees" % (user, repo),
+                                method="POST",
+                                payload=json.dumps({
+                                    "base_tree" : head["commit"]["tree"]["sha"],
+                                    "tree"      : tree}))
+        if response.status_code != 201:
+            raise HTTPException("Attempt to create tree in %s/%s returned %d (%s)",
+                                user, repo,
+                                response.status_code, response.content)
+        tree_sha = json.loads(response.content)["sha"]
+
+        response = self.request("/repos/%s/%s/git/commits" % (user, repo),
+                                method="POST",
+                                payload=json.dumps({
+                                    "message"   : message,
+                                    "tree"      : tree_sha,
+                                    "parents"   : [parent],
+                                    "committer" : {
+                                        "name"  : self.user['name'],
+                                        "email" : self.user['email'],
+                                        }}))
+        if response.status_code != 201:
+            raise HTTPException("Attempt to create commit in %s/%s returned %d (%s)",
+                                user, repo,
+                                response.status_code, response.content)
+        sha1 = json.loads(response.content)["sha"]
+
+        response = self.request("/repos/%s/%s/git/refs/heads/%s" % (user, repo, branch),
+                                method="PATCH",
+                                payload=json.dumps({"sha": sha1, "force": False}))
+        if response.status_code != 200:
+            raise HTTPException("Attempt to move %s/%s:%s to %s returned %d (%s)",
+                                user, repo, branch, sha1,
+                                response.status_code, response.content)
+        self.log.info("Committed %d files to %s/%s:%s (%s -> %s)",
+                      len(files), user, repo, branch, parent, sha1)
+        return parent, sha1
+
     # pylint: disable=too-many-arguments
     def commit_file(self, user, repo, path, content, message,
                     branch='master'):
@@ -156,36 +252,12 @@ class GithubEndpoint(APIEndpointBase):
             content     (str)   file contents
             message     (str)   commit message
         """
-        # Find the SHA1 of the existing file, if it exists
-        response = self.request("/repos/%s/%s/contents/%s" % (user, repo, path),
-                                payload=json.dumps({
-                                    "path"      : path,
-                                    "ref"       : branch}))
-        if response.status_code == 404:
-            sha1 = None
-        else:
-            current = json.loads(response.content)
-            sha1 = current['sha']
-
-        parameters = {
-            "path"      : path,
-            "message"   : message,
-            "branch"    : branch,
-            "content"   : base64.b64encode(content),
-            "committer": {
-                "name"  : self.user['name'],
-                "email" : self.user['email'],
-                },
-            }
-        if sha1 is not None:
-            parameters['sha'] = sha1
-
-        response = self.request("/repos/%s/%s/contents/%s" % (user, repo, path),
-                                payload=json.dumps(parameters),
-                                method="PUT")
-        if sha1 is None:
-            return response.status_code == 201
-        return response.status_code == 200
+        try:
+            self.commit_files(user, repo, {path: content}, message, branch=branch)
+        except HTTPException as e:
+            self.log.error("Failed to commit %s: %s", path, repr(e))
+            return False
+        return True
 
 
     # pylint: disable=too-many-arguments
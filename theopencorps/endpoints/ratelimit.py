@@ -0,0 +1,159 @@
+"""
+Rate limit aware scheduling of API requests
+
+GitHub tells us how much of our quota is left with every response
+(X-RateLimit-Remaining / X-RateLimit-Reset) and may ask us to back off
+with Retry-After.  Rather than running into the limit and failing tasks we
+spread the remaining quota over the time left in the window using a token
+bucket per API token.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+
+
+class _Bucket(object):
+    """
+    Rate limit state for a single token
+    """
+    def __init__(self, burst):
+        self.tokens = float(burst)
+        self.rate = None            # Tokens per second, None until we know
+        self.remaining = None
+        self.reset = None
+        self.blocked_until = 0.0
+        self.updated = time.time()
+
+    def refill(self, now, burst):
+        if self.reset is not None and now >= self.reset:
+            # The window is over, forget what we learned about it so a
+            # request can go out and tell us about the next one
+            self.rate = self.remaining = self.reset = None
+            self.tokens = float(burst)
+        elif self.rate is not None:
+            self.tokens = min(float(burst),
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter(object):
+    """
+    Token bucket scheduler keyed on API token
+
+        burst       (int)   requests we allow back-to-back
+
+    Until a response has told us about the quota for a token we don't
+    limit it at all, so endpoints that don't report limits (Travis) are
+    unaffected.
+    """
+
+    def __init__(self, burst=10):
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, token):
+        bucket = self._buckets.get(token)
+        if bucket is None:
+            bucket = self._buckets[token] = _Bucket(self.burst)
+        return bucket
+
+    def update(self, token, headers):
+        """
+        Record the quota reported in the headers of a response
+        """
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        retry_after = headers.get("Retry-After")
+        if remaining is None and retry_after is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            bucket = self._bucket(token)
+            bucket.refill(now, self.burst)
+            if remaining is not None and reset is not None:
+                try:
+                    bucket.remaining = int(remaining)
+                    bucket.reset = float(reset)
+                except ValueError:
+                    return
+                bucket.rate = bucket.remaining / max(bucket.reset - now, 1.0)
+                bucket.tokens = min(bucket.tokens, float(bucket.remaining))
+                if bucket.remaining <= 0:
+                    bucket.blocked_until = max(bucket.blocked_until, bucket.reset)
+            if retry_after is not None:
+                try:
+                    bucket.blocked_until = max(bucket.blocked_until,
+                                               now + float(retry_after))
+                except ValueError:
+                    pass
+
+    def reserve(self, token, max_wait):
+        """
+        Claim a request slot for token
+
+        Returns (granted, wait).  If granted the caller must wait that many
+        seconds before sending.  Otherwise the wait would exceed max_wait,
+        nothing has been claimed, and the caller should defer the work.
+        """
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(token)
+            if bucket is None:
+                return True, 0.0
+            bucket.refill(now, self.burst)
+
+            wait = max(bucket.blocked_until - now, 0.0)
+            if bucket.rate is not None and bucket.tokens < 1.0:
+                # The bucket is refilled when the window resets, whatever
+                # the rate
+                until_reset = max(bucket.reset - now, 0.0)
+                if bucket.rate <= 0.0:
+                    refilled = until_reset
+                else:
+                    refilled = min((1.0 - bucket.tokens) / bucket.rate, until_reset)
+                wait = max(wait, refilled)
+
+            if wait > max_wait:
+                return False, wait
+            bucket.tokens -= 1.0
+            if bucket.remaining is not None:
+                bucket.remaining -= 1
+            return True, wait
+
+    def budget(self, token):
+        """
+        Current view of the quota for token, or None if we know nothing
+        """
+        with self._lock:
+            bucket = self._buckets.get(token)
+            if bucket is None:
+                return None
+            bucket.refill(time.time(), self.burst)
+            return {"remaining": bucket.remaining,
+                    "reset": bucket.reset,
+                    "tokens": bucket.tokens,
+                    "rate": bucket.rate,
+                    "blocked_until": bucket.blocked_until}
@@ -0,0 +1,345 @@
+"""
+HTTP transports for the API endpoints
+
+APIEndpointBase doesn't talk to the network itself, it asks a transport to
+start a call and later collects the response.  This lets us use
+
+    URLFetchTransport       the GAE URLFetch service (the default)
+    PooledHTTPTransport     keep-alive connections with gzip transfer, for
+                            running the endpoints in a worker outside GAE
+    FakeTransport           canned in-memory responses for tests and benchmarks
+
+A response is anything with status_code, content and headers (which must
+be case insensitive) members.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import httplib
+import socket
+import threading
+import urlparse
+import zlib
+
+# Only available when running on GAE
+try:
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import urlfetch
+except ImportError:
+    apiproxy_stub_map = None
+    urlfetch = None
+
+
+class TransportError(Exception):
+    """We didn't get a response at all"""
+    pass
+
+
+class Headers(dict):
+    """
+    Case insensitive mapping of HTTP headers
+    """
+    def __init__(self, items=()):
+        dict.__init__(self)
+        for name, value in items:
+            self[name] = value
+
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name.lower(), value)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+class Response(object):
+    """
+    A response as returned by transports other than URLFetch
+    """
+    def __init__(self, status_code=200, content="", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = Headers((headers or {}).items())
+
+
+class Transport(object):
+    """
+    Interface every transport implements
+    """
+
+    # pylint: disable=too-many-arguments
+    def start(self, url, payload=None, method="GET", headers=None,
+              allow_truncated=False, follow_redirects=True,
+              validate_certificate=None, deadline=None):
+        """
+        Begin a request, returns a call object with a get_result() method
+        which blocks until the response is available and raises
+        TransportError if it never will be
+        """
+        raise NotImplementedError
+
+    def wait_any(self, calls):
+        """
+        Block until one of calls has completed and return it
+        """
+        raise NotImplementedError
+
+
+class _URLFetchCall(object):
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+
+    def get_result(self):
+        try:
+            return self.rpc.get_result()
+        except urlfetch.Error as e:
+            raise TransportError(repr(e))
+
+
+class URLFetchTransport(Transport):
+    """
+    Google App Engine URLFetch service
+    """
+
+    # pylint: disable=too-many-arguments
+    def start(self, url, payload=None, method="GET", headers=None,
+              allow_truncated=False, follow_redirects=True,
+              validate_certificate=None, deadline=None):
+        rpc = urlfetch.create_rpc(deadline=deadline)
+        urlfetch.make_fetch_call(rpc, url,
+                                 payload=payload,
+                                 method=method,
+                                 headers=headers or {},
+                                 allow_truncated=allow_truncated,
+                                 follow_redirects=follow_redirects,
+                                 validate_certificate=validate_certificate)
+        return _URLFetchCall(rpc)
+
+    def wait_any(self, calls):
+        calls = dict((call.rpc, call) for call in calls)
+        return calls[apiproxy_stub_map.UserRPC.wait_any(calls.keys())]
+
+
+class _ThreadedCall(object):
+    """
+    Runs a blocking fetch on a thread of its own
+    """
+    def __init__(self, fetch, condition):
+        self._condition = condition
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        thread = threading.Thread(target=self._run, args=(fetch,))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, fetch):
+        try:
+            self._result = fetch()
+        except Exception as e:  # pylint: disable=broad-except
+            self._error = e
+        with self._condition:
+            self._done.set()
+            self._condition.notify_all()
+
+    def done(self):
+        return self._done.is_set()
+
+    def get_result(self):
+        self._done.wait()
+        if self._error is not None:
+            if isinstance(self._error, TransportError):
+                raise self._error
+            raise TransportError(repr(self._error))
+        return self._result
+
+
+class PooledHTTPTransport(Transport):
+    """
+    httplib based transport keeping connections alive between requests
+
+        max_idle    idle connections kept per host
+        timeout     default socket timeout in seconds
+
+    Bodies are requested gzip encoded and decompressed transparently.
+    Asynchronous calls each run on a thread of their own.
+    """
+    _max_redirects = 5
+
+    # Methods we may send again if we can't tell whether the server got them
+    _idempotent = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+    def __init__(self, max_idle=4, timeout=30.0):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+
+    def _connection(self, scheme, netloc, timeout):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=timeout), False
+        return httplib.HTTPConnection(netloc, timeout=timeout), False
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _send(self, url, payload, method, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+        headers = dict(headers or {})
+        headers.setdefault("Accept-Encoding", "gzip")
+        headers.setdefault("Connection", "keep-alive")
+
+        # A pooled connection may have been closed by the server, in which
+        # case we try again on a fresh one.  Once the request has been sent
+        # the server may have acted on it, so only if it's safe to repeat.
+        while True:
+            connection, reused = self._connection(parts.scheme, parts.netloc, timeout)
+            sent = False
+            try:
+                connection.request(method, path, payload, headers)
+                sent = True
+                response = connection.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if reused and (not sent or method in self._idempotent):
+                    continue
+                raise TransportError("%s %s failed: %s" % (method, url, repr(e)))
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(parts.scheme, parts.netloc, connection)
+
+        if response.getheader("Content-Encoding", "") == "gzip":
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        return Response(response.status, content, dict(response.getheaders()))
+
+    # pylint: disable=too-many-arguments
+    def fetch(self, url, payload=None, method="GET", headers=None,
+              allow_truncated=False, follow_redirects=True,
+              validate_certificate=None, deadline=None):
+        """
+        Synchronous request, following redirects if asked to
+        """
+        timeout = deadline if deadline is not None else self.timeout
+        for _ in range(self._max_redirects + 1):
+            response = self._send(url, payload, method, headers, timeout)
+            location = response.headers.get("Location")
+            if not follow_redirects or location is None or \
+                                response.status_code not in (301, 302, 303, 307, 308):
+                return response
+            url = urlparse.urljoin(url, location)
+            if response.status_code == 303:
+                method, payload = "GET", None
+        raise TransportError("Too many redirects fetching %s" % url)
+
+    # pylint: disable=too-many-arguments
+    def start(self, url, payload=None, method="GET", headers=None,
+              allow_truncated=False, follow_redirects=True,
+              validate_certificate=None, deadline=None):
+        return _ThreadedCall(lambda: self.fetch(url, payload, method, headers,
+                                                allow_truncated, follow_redirects,
+                                                validate_certificate, deadline),
+                             self._condition)
+
+    def wait_any(self, calls):
+        with self._condition:
+            while True:
+                for call in calls:
+                    if call.done():
+                        return call
+                self._condition.wait()
+
+
+class _CompletedCall(object):
+
+    def __init__(self, result=None, error=None):
+        self._result = result
+        self._error = error
+
+    def get_result(self):
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class FakeTransport(Transport):
+    """
+    Serves canned responses from memory
+
+    Register responses with add(), anything unknown gets a 404.  Every
+    request made is appended to requests as a dict of its arguments.
+    """
+    def __init__(self):
+        self.requests = []
+        self._routes = {}
+
+    # pylint: disable=too-many-arguments
+    def add(self, method, url, status_code=200, content="", headers=None,
+            handler=None):
+        """
+        Respond to method url with the given response, or by calling
+        handler(**request) which returns a Response or raises TransportError
+        """
+        if handler is None:
+            response = Response(status_code, content, headers)
+            handler = lambda **request: response
+        self._routes[(method, url)] = handler
+
+    # pylint: disable=too-many-arguments
+    def start(self, url, payload=None, method="GET", headers=None,
+              allow_truncated=False, follow_redirects=True,
+              validate_certificate=None, deadline=None):
+        request = {"url": url, "payload": payload, "method": method,
+                   "headers": dict(headers or {})}
+        self.requests.append(request)
+        handler = self._routes.get((method, url))
+        if handler is None:
+            return _CompletedCall(Response(404, '{"message": "Not Found"}'))
+        try:
+            return _CompletedCall(handler(**request))
+        except TransportError as e:
+            return _CompletedCall(error=e)
+
+    def wait_any(self, calls):
+        return calls[0]
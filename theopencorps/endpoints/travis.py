@@ -27,10 +27,12 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 import json
 import time
 import base64
+import hashlib
 
 import rsa
 
-from theopencorps.endpoints import APIEndpointBase, cache, HTTPException, auth
+from theopencorps.endpoints import APIEndpointBase, memoize, HTTPException, auth, \
+                                   RateLimited, RetryPolicy
 
 
 class TravisEndpoint(APIEndpointBase):
@@ -38,8 +40,11 @@ class TravisEndpoint(APIEndpointBase):
     _endpoint = "https://api.travis-ci.org"
     _accept = "application/vnd.travis-ci.2+json"
 
-    def __init__(self, token=None):
-        APIEndpointBase.__init__(self)
+    # How patiently we poll for a blocking sync to complete
+    _sync_poll = RetryPolicy(attempts=10, base=0.05, cap=1.0, deadline=5.0)
+
+    def __init__(self, token=None, transport=None):
+        APIEndpointBase.__init__(self, transport=transport)
         self.token = "\"%s\"" % token
 
     def login(self):
@@ -95,20 +100,15 @@ class TravisEndpoint(APIEndpointBase):
         response = self.request("/users/sync", method="POST")
         if response.status_code not in [200, 409]:
             raise HTTPException("Sync request returned %d", response.status_code)
-        count = 0
-        while block:
-            response = json.loads(self.request("/users/").content)
-            user = response['user']
-            if not user['is_syncing']:
-                self.log.info("Synchronised at %s after %d polls", 
-                              user['synced_at'],
-                              count)
-                break
-            # Busy waiting on an HTTP API probably isn't that friendly...
-            time.sleep(0.01)
-            count += 1
-            if count > 50:
-                raise HTTPException("Failed to sync within 0.5 seconds")
+        if not block:
+            return
+        delays = self._sync_poll.backoff(time.time())
+        while not self.is_synced():
+            delay = next(delays, None)
+            if delay is None:
+                raise HTTPException("Failed to sync within %.1f seconds",
+                                    self._sync_poll.deadline)
+            time.sleep(delay)
 
     @auth
     def is_synced(self):
@@ -119,9 +119,69 @@ class TravisEndpoint(APIEndpointBase):
         self.log.info("Still waiting for travis to synchronise")
         return False
 
+    @auth
+    def get_hook_state(self, owner, repo_name):
+        """
+        Everything needed to enable the hook for a repository, fetched in
+        parallel
+
+        Returns (is_synced, hooks, repo) where hooks is an iterator over the
+        hooks and repo is the decoded JSON or None if it couldn't be retrieved
+        """
+        hooks = self.get_hooks()
+        responses = self.request_many(["/users/",
+                                       "/repos/%s/%s" % (owner, repo_name)])
+        decoded = []
+        for response in responses:
+            if isinstance(response, RateLimited):
+                raise response
+            if isinstance(response, HTTPException) or response.status_code != 200:
+                decoded.append(None)
+            else:
+                decoded.append(json.loads(response.content))
+        user, repo = decoded
+
+        synced = user is not None and not user['user']['is_syncing']
+        if not synced:
+            self.log.info("Still waiting for travis to synchronise")
+        return synced, hooks, repo
+
+    @auth
+    def configure_repo(self, repo_id, hook_id=None, **settings):
+        """
+        Enable the hook (unless hook_id is None) and update the settings of a
+        repository in parallel
+
+        Returns True if the settings were updated, raises if the hook could not
+        be enabled
+        """
+        requests = [("/repos/%d/settings" % repo_id,
+                     {"method": "PATCH",
+                      "payload": json.dumps({"settings": settings})})]
+        if hook_id is not None:
+            requests.append(('/hooks/%d' % hook_id,
+                             {"method": "PUT",
+                              "payload": json.dumps({"hook": {'active': True}})}))
+
+        responses = self.request_many(requests)
+        for response in responses:
+            if isinstance(response, RateLimited):
+                raise response
+        settings_ok = not isinstance(responses[0], HTTPException) and \
+                                        responses[0].status_code == 200
+        if hook_id is not None:
+            response = responses[1]
+            if isinstance(response, HTTPException) or response.status_code != 200:
+                self.log.info("Retrying hook %d with alternative API call", hook_id)
+                self.enable_hook(hook_id)
+        return settings_ok
+
     @auth
     def get_hooks(self):
-        return self.request_json("/hooks")
+        """
+        Iterate over all hooks, the first page is requested immediately
+        """
+        return self.paginate("/hooks", items_key="hooks")
 
     @auth
     def enable_hook(self, hook_id):
@@ -149,10 +209,23 @@ class TravisEndpoint(APIEndpointBase):
         return True
 
     @auth
-    @cache
+    @memoize(ttl=24 * 60 * 60, maxsize=256)
     def get_key(self, owner, repo_name):
-        response = json.loads(self.request('/repos/%s/%s/key' % (owner, repo_name)).content)
-        return response['key']
+        response = self.request('/repos/%s/%s/key' % (owner, repo_name))
+        if response.status_code != 200:
+            raise HTTPException("Attempt to retrieve key for %s/%s returned %d",
+                                owner, repo_name, response.status_code)
+        return json.loads(response.content)['key']
+
+    @auth
+    @memoize(ttl=24 * 60 * 60, maxsize=256)
+    def get_public_key(self, owner, repo_name):
+        """
+        Returns (fingerprint, key) for the repository with the key already
+        parsed, fingerprint being the SHA1 of the PEM
+        """
+        pem = str(self.get_key(owner, repo_name))
+        return hashlib.sha1(pem).hexdigest(), rsa.PublicKey.load_pkcs1_openssl_pem(pem)
 
     @auth
     def encrypt(self, owner, repo_name, string):
@@ -161,8 +234,6 @@ class TravisEndpoint(APIEndpointBase):
 
         Returns a base64 encoded string suitable for use in YML file
         """
-        rsa_key = self.get_key(owner, repo_name)
-        pubkey = rsa.PublicKey.load_pkcs1_openssl_pem(rsa_key)
+        _, pubkey = self.get_public_key(owner, repo_name)
         secure = rsa.encrypt(string.encode('utf8'), pubkey)
         return base64.b64encode(secure)
-
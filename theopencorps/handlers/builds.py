@@ -22,15 +22,51 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import json
 import logging
-import ansiconv
 
-import cloudstorage as gcs
+from google.appengine.ext import ndb
 
 import theopencorps.paths as paths
 import theopencorps.auth
 
-from theopencorps.datamodel.models import Project, Repository, TravisJob, Push, JUnitTestResult
+from theopencorps.datamodel.models import Project, Repository, TravisJob, Push, JUnitTestResult, \
+                                          LogIndex, LogSummary, TestCaseDictionary
+from theopencorps.handlers.logs import read_lines, rendered_log_name, LOG_HTML_VERSION
+from theopencorps.handlers.results import decode_testsuite
+
+
+def find_sim_job(push):
+    """
+    Returns the valid JUnit result for push and the TravisJob that produced it
+    """
+    junit = JUnitTestResult.query(JUnitTestResult.push==push.key).fetch()
+    junit = [j for j in junit if j.valid]
+    logging.info("Found %d junit results for sha %s", len(junit), push.key.id())
+    junit = junit[0]
+    return junit, junit.travis_job.get()
+
+
+def log_name(logfile):
+    return logfile.split('/')[-1].split(".")[0]
+
+
+def find_log(push, name):
+    """
+    Returns the valid TravisJob of push with a log called name and the
+    logfile, or (None, None)
+
+    Travis builds the commits we made in the fork, so a job's commit may
+    be any of those of the push
+    """
+    commits = set([push.key.id(), push.fork_merge, push.travis_update]) - set([None, ""])
+    for job in TravisJob.query(TravisJob.commit.IN(list(commits))).fetch():
+        if job.valid is False:
+            continue
+        for logfile in job.logfiles:
+            if log_name(logfile) == name:
+                return job, logfile
+    return None, None
 
 
 class BuildHandler(theopencorps.auth.BaseSessionHandler):
@@ -62,19 +98,20 @@ class BuildHandler(theopencorps.auth.BaseSessionHandler):
             return
 
         repo = project.repo.get()
-        junit = JUnitTestResult.query(JUnitTestResult.push==push.key).fetch()
-        junit = [j for j in junit if j.valid]
-        logging.info("Found %d junit results for sha %s", len(junit), sha1)
-        junit = junit[0]
-
-        sim_job = junit.travis_job.get()
+        junit, sim_job = find_sim_job(push)
+        testcases = decode_testsuite(junit, TestCaseDictionary.get_by_id(fullname))
 
+        # Logs are rendered to HTML in the background after upload, the
+        # page fetches them a piece at a time from LogViewHandler
         sim_logfiles = []
-
-        for logfile in sim_job.logfiles:
-            gcs_file = gcs.open(logfile)
-            sim_logfiles.append((logfile.split('/')[-1].split(".")[0], ansiconv.to_html(gcs_file.read())))
-            gcs_file.close()
+        pending = False
+        summaries = ndb.get_multi([ndb.Key(LogSummary, logfile) for logfile in sim_job.logfiles])
+        for logfile, summary in zip(sim_job.logfiles, summaries):
+            ready = rendered_log_name(logfile) in sim_job.rendered
+            pending = pending or not ready
+            sim_logfiles.append((log_name(logfile), ready, summary))
+        if pending:
+            sim_job.render_async(LOG_HTML_VERSION)
 
         template = paths.JINJA_ENVIRONMENT.get_template('build.html')
         self.response.write(template.render(user=self.user,
@@ -82,6 +119,60 @@ class BuildHandler(theopencorps.auth.BaseSessionHandler):
                                             repo=repo,
                                             push=push,
                                             junit=junit,
+                                            testcases=testcases,
                                             sim_job=sim_job,
                                             sim_logfiles=sim_logfiles))
         return
+
+
+class LogViewHandler(theopencorps.auth.BaseSessionHandler):
+
+    """
+    Lines of a rendered simulation log as JSON, query parameters:
+
+        offset      first line to return (default 0)
+        length      how many lines (default and maximum _max_lines)
+        tail        return the last tail lines instead
+    """
+    _max_lines = 1000
+
+    def error(self, status, message):
+        self.response.set_status(status)
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps({"message": message}))
+
+    def get(self, user, repo, sha1, name):
+        fullname = "%s/%s" % (user, repo)
+        project, push = ndb.get_multi([ndb.Key(Project, fullname), ndb.Key(Push, sha1)])
+        if project is None:
+            return self.error(404, "Project %s not found" % fullname)
+        if push is None:
+            return self.error(404, "Commit %s not found" % sha1)
+
+        try:
+            offset = int(self.request.get("offset", "0"))
+            length = min(int(self.request.get("length", str(self._max_lines))), self._max_lines)
+            tail = int(self.request.get("tail", "0"))
+        except ValueError:
+            return self.error(400, "Invalid offset, length or tail")
+
+        job, logfile = find_log(push, name)
+        if job is None:
+            return self.error(404, "Log %s not found" % name)
+
+        rendered = rendered_log_name(logfile)
+        index = LogIndex.get_by_id(rendered) if rendered in job.rendered else None
+        if index is None:
+            job.render_async(LOG_HTML_VERSION)
+            return self.error(404, "Log %s is still being processed" % name)
+
+        if tail > 0:
+            length = min(tail, self._max_lines)
+            offset = max(index.lines - length, 0)
+        lines = read_lines(index, offset, length)
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps({"name": name,
+                                        "lines": index.lines,
+                                        "offset": offset,
+                                        "html": "\n".join(lines)}))
@@ -19,24 +19,209 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import hashlib
 import logging
 import json
+import time
 
 import webapp2
 from google.appengine.ext import ndb
-from google.appengine.api import taskqueue
+from google.appengine.api import memcache
 
 import theopencorps.auth
 import theopencorps.secrets as config
 
-from theopencorps.datamodel.models import Push, TravisJob, TravisBuild
+from theopencorps.datamodel import insert_or_update_multi
+from theopencorps.datamodel.models import Project, Push, PushAlias, TravisJob, TravisBuild
+from theopencorps.datamodel.project import schedule_advance
 
+from theopencorps.endpoints import LRUCache
 from theopencorps.endpoints.travis import TravisEndpoint
 
 
 class HookException(Exception):
     pass
 
+
+class TravisBuildCache(object):
+    """
+    Travis build metadata shared between all the uploads of a build
+
+    A job typically posts a JUnit file and several logs within seconds of
+    each other, all of which need the same build information.  We keep it in
+    an in-process LRU backed by memcache, keyed on the build id.
+
+    While the job we're asked about is still running the entry is only
+    trusted for ttl seconds.  Once the job has reached a terminal state
+    nothing more changes so we keep using it until it's evicted.
+    """
+    _terminal = frozenset(["passed", "failed", "errored", "canceled"])
+
+    def __init__(self, ttl=30, maxsize=256, namespace="hooks.travis_build"):
+        self.ttl = ttl
+        self.namespace = namespace
+        self._local = LRUCache(maxsize)
+
+    def _is_terminal(self, data, job_id):
+        for job in data["jobs"]:
+            if job["id"] == job_id:
+                return job["state"] in self._terminal
+        return False
+
+    def get(self, travis, build_id, job_id):
+        """
+        Returns the decoded build JSON for build_id, only asking Travis if
+        we don't have a usable copy
+        """
+        entry = self._local.get(build_id)
+        if entry is None:
+            entry = memcache.get(str(build_id), namespace=self.namespace)
+            if entry is not None:
+                self._local.put(build_id, entry)
+
+        if entry is not None:
+            fetched, data = entry
+            if self._is_terminal(data, job_id) or fetched + self.ttl > time.time():
+                logging.debug("Using cached metadata for travis build %d", build_id)
+                return data
+
+        response = travis.get_build(build_id)
+        data = {"build": response["build"], "jobs": response["jobs"]}
+        entry = (time.time(), data)
+        self._local.put(build_id, entry)
+        memcache.set(str(build_id), entry, namespace=self.namespace)
+        return data
+
+_build_cache = TravisBuildCache()
+
+
+class DedupeStore(object):
+    """
+    Remembers which deliveries we've already processed
+
+    A key is first claimed as in progress, then marked done once the
+    request has succeeded, or released if it failed so a retry is
+    processed.  memcache.add is atomic so only one of several concurrent
+    duplicates gets to claim a key.  Completed keys are also kept in an
+    in-process LRU so repeats to the same instance don't even need a
+    memcache round-trip.
+    """
+    CLAIMED = "claimed"
+    IN_PROGRESS = "in progress"
+    DONE = "done"
+
+    def __init__(self, ttl=24 * 60 * 60, in_progress_ttl=10 * 60, maxsize=1024,
+                 namespace="hooks.dedupe"):
+        self.ttl = ttl
+        self.in_progress_ttl = in_progress_ttl
+        self.namespace = namespace
+        self._local = LRUCache(maxsize)
+
+    def claim(self, key):
+        """
+        Returns CLAIMED if key hasn't been seen before, marking it as in
+        progress, otherwise IN_PROGRESS or DONE
+        """
+        if self._local.get(key):
+            return self.DONE
+        if not memcache.add(key, self.IN_PROGRESS, time=self.in_progress_ttl,
+                            namespace=self.namespace):
+            state = memcache.get(key, namespace=self.namespace)
+            if state is not None:
+                return self.DONE if state == self.DONE else self.IN_PROGRESS
+            # add also fails if memcache is unavailable, in which case it's
+            # better to process a duplicate than to drop the delivery
+            logging.warning("Unable to record delivery %s, processing anyway", key)
+        return self.CLAIMED
+
+    def complete(self, key):
+        """
+        The request for key succeeded, ignore repeats from now on
+        """
+        self._local.put(key, True)
+        memcache.set(key, self.DONE, time=self.ttl, namespace=self.namespace)
+
+    def release(self, key):
+        """
+        Forget key, so that a retry gets processed
+        """
+        self._local.discard(key)
+        memcache.delete(key, namespace=self.namespace)
+
+_dedupe = DedupeStore()
+
+
+def github_delivery(handler, project):
+    """
+    Github gives every webhook delivery a unique ID, redeliveries reuse it
+    """
+    delivery = handler.request.headers.get("X-GitHub-Delivery", "")
+    if not delivery:
+        return None
+    return "delivery:%s" % delivery
+
+
+def payload_digest(handler, project):
+    """
+    Digest of an upload from Travis, covering which job it was for and where
+    it was posted as well as the payload itself.
+
+    The payload is represented by its HMAC signature so that streamed
+    uploads don't have to be read to work this out.  If the signature turns
+    out not to match, the handler fails and the key is released.
+    """
+    digest = hashlib.sha1()
+    digest.update(handler.request.path)
+    digest.update("\0%s" % handler.request.headers.get("Travis-JobID", ""))
+    digest.update("\0%s\0" % handler.request.headers.get("Content-Filename", ""))
+    digest.update(handler.request.headers.get("X-Hub-Signature", ""))
+    return "payload:%s:%s" % (project.key.id(), digest.hexdigest())
+
+
+def idempotent(key_func):
+    """
+    Decorator to drop requests we've already processed before any datastore
+    or storage work happens.  Must be applied inside validate_token (or
+    validate_stream_token).
+
+    key_func(handler, project) returns the key identifying the request, or
+    None if it can't be identified.  Unless the handler succeeds, however
+    it stops (including DeadlineExceededError), the key is released so that
+    a retry isn't ignored.  A duplicate arriving while the first is still
+    being processed gets a 503, since the first may yet fail.
+    """
+    def _wrap(handler_method):
+        def check_duplicate(self, project, *args, **kwargs):
+            key = key_func(self, project)
+            if key is None:
+                return handler_method(self, project, *args, **kwargs)
+
+            state = _dedupe.claim(key)
+            if state == DedupeStore.DONE:
+                logging.info("Ignoring duplicate request %s for %s", key, project.full_name)
+                self.response.set_status(200)
+                self.response.write("Duplicate request ignored")
+                return
+            if state == DedupeStore.IN_PROGRESS:
+                logging.info("Request %s for %s is already in progress", key, project.full_name)
+                self.response.set_status(503)
+                self.response.headers["Retry-After"] = "30"
+                self.response.write("Duplicate request still in progress")
+                return
+
+            succeeded = False
+            try:
+                result = handler_method(self, project, *args, **kwargs)
+                succeeded = self.response.status_int < 400
+                return result
+            finally:
+                if succeeded:
+                    _dedupe.complete(key)
+                else:
+                    _dedupe.release(key)
+        return check_duplicate
+    return _wrap
+
 class GithubWebHookHandler(theopencorps.auth.TokenValidatedHandler):
 
     """
@@ -47,6 +232,7 @@ class GithubWebHookHandler(theopencorps.auth.TokenValidatedHandler):
     """
 
     @theopencorps.auth.validate_token("X-Hub-Signature")
+    @idempotent(github_delivery)
     def post(self, project):
 
         try:
@@ -86,7 +272,7 @@ class GithubWebHookHandler(theopencorps.auth.TokenValidatedHandler):
             logging.warning("Already seem to have a Build event tracking %s", sha1)
             logging.debug(repr(request))
             logging.debug(repr(push.to_dict()))
-            taskqueue.add(url="/%s" % repo.full_name)
+            schedule_advance(repo.full_name)
             return
 
         got = request['repository']['full_name']
@@ -113,7 +299,7 @@ class GithubWebHookHandler(theopencorps.auth.TokenValidatedHandler):
         # Reset any failures
         project.failure_count = 0
         project.put()
-        taskqueue.add(url="/%s" % repo.full_name)
+        schedule_advance(repo.full_name)
         return
 
 
@@ -131,12 +317,73 @@ class CustomTravisHookHandler(theopencorps.auth.TokenValidatedHandler):
         theopencorps.auth.TokenValidatedHandler.__init__(self, *args, **kwargs)
         self._job = None
         self._build = None
+        self._loaded = {}
+
+    def _header_id(self, name):
+        try:
+            return int(self.request.headers.get(name, "0"))
+        except ValueError:
+            return 0
+
+    def get_project(self, user, repo):
+        """
+        Everything an upload refers to can be worked out from the URL and
+        headers, so we load the project, push, push alias, job and build
+        together in one batch rather than one round-trip each
+        """
+        try:
+            return self.project
+        except AttributeError:
+            pass
+        fullname = "%s/%s" % (user, repo)
+        commit = self.request.headers.get("Travis-Commit", "")
+        build_id = self._header_id("Travis-BuildID")
+        job_id = self._header_id("Travis-JobID")
+
+        keys = {"project": ndb.Key(Project, fullname)}
+        if commit:
+            keys["push"] = ndb.Key(Push, commit)
+            keys["alias"] = ndb.Key(PushAlias, commit)
+        if build_id:
+            keys["build"] = ndb.Key(TravisBuild, build_id)
+        if job_id:
+            keys["job"] = ndb.Key(TravisJob, job_id)
+
+        names = keys.keys()
+        futures = ndb.get_multi_async([keys[name] for name in names])
+        self._loaded = dict((name, future.get_result()) for name, future in zip(names, futures))
+
+        project = self._loaded["project"]
+        if project is not None:
+            logging.info("Found project %s (id: %s)", fullname, project.key.id)
+        else:
+            logging.warning("Failed to find project %s", fullname)
+        self.project = project
+        return project
+
+    def save(self, *entities):
+        """
+        Write back our updates to the TravisJob / TravisBuild in a single
+        cross-group transaction, unless the copies loaded with the project
+        already have them
+        """
+        loaded = dict((entity.key, entity) for entity in self._loaded.values()
+                                                    if entity is not None)
+        pending = []
+        for entity in entities:
+            stored = loaded.get(entity.key)
+            if stored is not None and stored.covers(entity):
+                logging.debug("%s %s already up to date", entity.__class__.__name__, entity.key.id())
+                continue
+            pending.append(entity)
+        if pending:
+            insert_or_update_multi(*pending)
 
     def get_build_and_job(self):
         """
         Since they are interlinked, we need to retrieve both at the same time
 
-        Assumes callee calls insert_or_update() when done
+        Assumes callee calls save() when done
         """
         travis_build_id = int(self.request.headers.get("Travis-BuildID", "0"))
         travis_job_id = int(self.request.headers.get("Travis-JobID", "0"))
@@ -146,7 +393,7 @@ class CustomTravisHookHandler(theopencorps.auth.TokenValidatedHandler):
             raise HookException("No travis build information")
 
         travis = TravisEndpoint(token=config.travis_token_post_auth)
-        travis_data = travis.get_build(travis_build_id)
+        travis_data = _build_cache.get(travis, travis_build_id, travis_job_id)
 
         job = TravisJob(id=travis_job_id,
                         travis_id=travis_job_id,
@@ -204,11 +451,19 @@ class CustomTravisHookHandler(theopencorps.auth.TokenValidatedHandler):
             logging.error("No commit information provided")
             return None
 
-        # Find the Push object that's tracking this commit
-        push = Push.get_by_id(commit)
+        # Find the Push object that's tracking this commit, either directly
+        # or via the alias of a commit we made in the fork
+        push = self._loaded.get("push")
         if push is not None:
             return push
 
+        alias = self._loaded.get("alias")
+        if alias is not None:
+            push = alias.push.get()
+            if push is not None:
+                return push
+
+        # Commits made before we kept aliases
         push = Push.query(ndb.OR(Push.fork_merge == commit,
                                  Push.travis_update == commit)).fetch()
         if not push:
@@ -19,16 +19,389 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import collections
+import hashlib
+import json
+import logging
+import re
+import uuid
+import zlib
+
+import ansiconv
 import cloudstorage as gcs
 
+from google.appengine.ext import ndb
+
 import theopencorps.auth
-from theopencorps.handlers.hooks import CustomTravisHookHandler
-from theopencorps.datamodel.models import AlteraSynthResult
+from theopencorps.handlers.hooks import CustomTravisHookHandler, idempotent, payload_digest
+from theopencorps.datamodel.models import AlteraSynthResult, TravisJob, LogIndex, LogSummary, \
+                                          LogBlob, LogUploadSession
+from theopencorps.logscan import LogScanner, ERROR, WARNING, ASSERTION
+
+
+# Part of the name of rendered logs, bump the revision if we change how we
+# render so that everything gets re-rendered
+LOG_HTML_VERSION = "%s.%d" % (getattr(ansiconv, "__version__", "0"), 3)
+
+# Rendered logs are stored as one gzip member per this many lines, so that
+# LogIndex can take us to any line with a single ranged read
+LOG_BLOCK_LINES = 256
+
+
+def _gzip(text):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+
+def _inflate(decompressor, data):
+    """
+    Decompress data, carrying on into any further gzip members
+
+    Returns the decompressor to use for the next data, and the text
+    """
+    text = []
+    while data:
+        text.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+        if data:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return decompressor, "".join(text)
+
+
+class UploadReader(object):
+    """
+    File-like view of the text of a SignedBody, decompressing it if it was
+    sent with Content-Encoding: gzip, for parsers that want to read()
+    """
+    def __init__(self, body, encoding=""):
+        self._chunks = iter(body)
+        self._decompressor = None
+        if encoding == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = ""
+
+    def _fill(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        if self._decompressor is not None:
+            self._decompressor, chunk = _inflate(self._decompressor, chunk)
+        self._buffer += chunk
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def drain(self):
+        """
+        Read whatever is left, so that the body can be verified
+        """
+        while self._fill():
+            self._buffer = ""
+        self._buffer = ""
+
+
+def store_log(project, job_id, name, body, encoding="", scanner=None):
+    """
+    Stream body (a SignedBody) into content addressed storage at
+    /buildlogs/blobs/<sha256 of the text>/<name>.gz, taking a reference to
+    the LogBlob for the job
+
+    Logs are stored gzip compressed.  If the upload was sent with
+    Content-Encoding: gzip we store the bytes as they arrived, otherwise we
+    compress as we go.  If given a LogScanner we feed it the text on the way.
+
+    If an upload with the same signature has been stored before we only
+    read the body to verify it, nothing is written.  Otherwise it is
+    written to a temporary object and only copied into place once the
+    signature has been verified and if nobody else stored the same content
+    already.  However large the log we only ever hold one chunk in memory.
+
+    Returns the filename, or None if the signature didn't match
+    """
+    suffix = "/%s.gz" % name
+    known = [blob.key.id() for blob in LogBlob.query(LogBlob.signatures == body.signature).fetch()
+                                    if blob.key.id().endswith(suffix)]
+
+    compressor = decompressor = gcs_file = None
+    if encoding != "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    incoming = "/buildlogs/.incoming/%s/%d/%s" % (project.key.id(), job_id, uuid.uuid4().hex)
+    if not known:
+        gcs_file = gcs.open(incoming, 'w', content_type='application/x-gzip')
+    digest = hashlib.sha256()
+    try:
+        for chunk in body:
+            text = chunk
+            if decompressor is not None:
+                decompressor, text = _inflate(decompressor, chunk)
+            digest.update(text)
+            if scanner is not None:
+                scanner.feed(text)
+            if gcs_file is None:
+                continue
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            gcs_file.write(chunk)
+        if gcs_file is not None and compressor is not None:
+            gcs_file.write(compressor.flush())
+    finally:
+        if gcs_file is not None:
+            gcs_file.close()
+    if scanner is not None:
+        scanner.close()
+
+    filename = blob_name(digest, name)
+    try:
+        if not body.verified:
+            logging.warning("Signature didn't match for %d byte log %s (got %s)",
+                            body.length, filename, body.digest)
+            return None
+        if filename in known:
+            logging.info("Already have %d byte log %s", body.length, filename)
+        else:
+            publish_log(incoming, filename)
+    finally:
+        if gcs_file is not None:
+            gcs.delete(incoming)
+    LogBlob.reference(filename, body.signature)
+    return filename
+
+
+def blob_name(digest, name):
+    """
+    Where a log with content digest (a sha256) is stored
+    """
+    return "/buildlogs/blobs/%s/%s.gz" % (digest.hexdigest(), name)
+
+
+def publish_log(incoming, filename):
+    """
+    Copy the gzipped log incoming to filename unless we have it already
+    """
+    if LogBlob.get_by_id(filename) is not None:
+        logging.info("Already have log %s, discarding upload", filename)
+        return
+    gcs.copy2(incoming, filename)
+    logging.info("Stored log %s", filename)
+
+
+def read_log(filename, chunk_size=256 * 1024):
+    """
+    Generator yielding the contents of a stored log in chunks,
+    decompressing as we go if it was stored gzipped
+    """
+    decompressor = None
+    if filename.endswith(".gz"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    gcs_file = gcs.open(filename)
+    try:
+        while True:
+            chunk = gcs_file.read(chunk_size)
+            if not chunk:
+                break
+            if decompressor is not None:
+                decompressor, chunk = _inflate(decompressor, chunk)
+            yield chunk
+        if decompressor is not None:
+            yield decompressor.flush()
+    finally:
+        gcs_file.close()
+
+
+def iter_lines(chunks, lines=LOG_BLOCK_LINES):
+    """
+    Regroup chunks of text into blocks of lines lines (the last may be
+    shorter)
+    """
+    pending = []
+    partial = ""
+    for chunk in chunks:
+        parts = (partial + chunk).split("\n")
+        partial = parts.pop()
+        pending.extend(line + "\n" for line in parts)
+        while len(pending) >= lines:
+            yield "".join(pending[:lines])
+            del pending[:lines]
+    if partial:
+        pending.append(partial)
+    if pending:
+        yield "".join(pending)
+
+
+def summarise_log(filename, job, scanner):
+    """
+    Returns the LogSummary of what scanner found in the log filename
+    """
+    return LogSummary(id=filename,
+                      travis_job=job.key,
+                      tools=scanner.tools,
+                      errors=scanner.counts[ERROR],
+                      warnings=scanner.counts[WARNING],
+                      assertions=scanner.counts[ASSERTION],
+                      entries=scanner.entries)
+
+
+def rendered_log_name(logfile):
+    """
+    Where the HTML of logfile is stored
+    """
+    return "%s.%s.html.gz" % (logfile, LOG_HTML_VERSION)
+
+
+_SGR_RE = re.compile(r"\x1b\[([0-9;]*)m")
+
+
+def _sgr_state(state, text):
+    """
+    Update state, an OrderedDict of the SGR codes in effect, with the
+    escapes in text.  Colours replace each other, other attributes are
+    kept in the order they were last set.
+    """
+    for match in _SGR_RE.finditer(text):
+        codes = match.group(1).split(";")
+        while codes:
+            code = codes.pop(0) or "0"
+            if code in ("38", "48"):
+                # Extended colour, 5;n or 2;r;g;b
+                extra = 2 if codes[:1] == ["5"] else 4
+                code = ";".join([code] + codes[:extra])
+                codes = codes[extra:]
+            number = int(code.split(";")[0])
+            if number == 0:
+                state.clear()
+                continue
+            if number in (38, 39) or 30 <= number <= 37 or 90 <= number <= 97:
+                key = "fg"
+            elif number in (48, 49) or 40 <= number <= 47 or 100 <= number <= 107:
+                key = "bg"
+            else:
+                key = code
+            state.pop(key, None)
+            state[key] = code
+    return state
+
+
+def render_log(logfile):
+    """
+    Convert the ANSI escapes in logfile to HTML, storing the result next
+    to it along with a LogIndex.  We work a block of lines at a time so
+    memory use doesn't depend on the size of the log, starting each block
+    with the colours the previous one left behind.
+
+    Returns the name of the rendered file
+    """
+    filename = rendered_log_name(logfile)
+    index = LogIndex(id=filename, lines=0, block_lines=LOG_BLOCK_LINES, offsets=[])
+    offset = 0
+    state = collections.OrderedDict()
+    gcs_file = gcs.open(filename, 'w', content_type='application/x-gzip')
+    try:
+        for block in iter_lines(read_log(logfile)):
+            prefix = "\x1b[%sm" % ";".join(state.values()) if state else ""
+            _sgr_state(state, block)
+            data = _gzip(ansiconv.to_html(prefix + block))
+            gcs_file.write(data)
+            index.offsets.append(offset)
+            index.lines += block.count("\n") + (0 if block.endswith("\n") else 1)
+            offset += len(data)
+    finally:
+        gcs_file.close()
+    index.offsets.append(offset)
+    index.put()
+    logging.info("Rendered %s to %s (%d lines)", logfile, filename, index.lines)
+    return filename
+
+
+def read_lines(index, offset, length):
+    """
+    Returns up to length lines of the rendered log index describes,
+    starting from line offset, with a single ranged read
+    """
+    offset = max(0, min(offset, index.lines))
+    length = max(0, min(length, index.lines - offset))
+    if not length:
+        return []
+    first = offset // index.block_lines
+    last = (offset + length - 1) // index.block_lines
+
+    gcs_file = gcs.open(index.key.id())
+    try:
+        gcs_file.seek(index.offsets[first])
+        data = gcs_file.read(index.offsets[last + 1] - index.offsets[first])
+    finally:
+        gcs_file.close()
+
+    lines = _inflate(zlib.decompressobj(16 + zlib.MAX_WBITS), data)[1].split("\n")
+    start = offset - first * index.block_lines
+    return lines[start:start + length]
+
+
+class JobRenderHandler(theopencorps.auth.BaseSessionHandler):
+
+    def post(self, job_id):
+        """
+        Task queue processor rendering the HTML of a job's logfiles
+        """
+        try:
+            job_id = int(job_id)
+        except Exception:
+            logging.warning("Job render handler called with %s", repr(job_id))
+            return
+        job = TravisJob.get_by_id(job_id)
+        if job is None:
+            logging.warning("Received request to render logs of %d but it wasn't found!", job_id)
+            return
+
+        # Logs are shared between jobs so may have been rendered already
+        missing = [logfile for logfile in job.logfiles
+                            if rendered_log_name(logfile) not in job.rendered]
+        indices = ndb.get_multi([ndb.Key(LogIndex, rendered_log_name(logfile))
+                                                    for logfile in missing])
+        rendered = [rendered_log_name(logfile) if index is not None else render_log(logfile)
+                                    for logfile, index in zip(missing, indices)]
+        if rendered:
+            TravisJob(id=job_id, rendered=rendered).insert_or_update()
+
+
+class LogCollectHandler(theopencorps.auth.BaseSessionHandler):
+
+    def post(self):
+        """
+        Task queue processor deleting a log nothing refers to any more,
+        along with everything derived from it
+        """
+        filename = self.request.get("filename")
+        if not LogBlob.collect(filename):
+            logging.info("Log %s is referenced again, not deleting", filename)
+            return
+        rendered = rendered_log_name(filename)
+        ndb.delete_multi([ndb.Key(LogIndex, rendered), ndb.Key(LogSummary, filename)])
+        for name in (filename, rendered):
+            try:
+                gcs.delete(name)
+            except gcs.NotFoundError:
+                pass
+        logging.info("Deleted unreferenced log %s", filename)
+
 
 class LogFileHandler(CustomTravisHookHandler):
 
-    @theopencorps.auth.validate_token("X-Hub-Signature")
-    def post(self, project):
+    # Simulation logs, see theopencorps.logscan.PATTERNS
+    _tools = ["vunit", "modelsim"]
+
+    @theopencorps.auth.validate_stream_token("X-Hub-Signature")
+    @idempotent(payload_digest)
+    def post(self, project, body):
         """
         We store the logfile on Google Cloud Storage
 
@@ -37,29 +410,49 @@ class LogFileHandler(CustomTravisHookHandler):
         travis_job_id = int(self.request.headers.get("Travis-JobID", "0"))
         fhint = self.request.headers.get("Content-Filename", "unknown")
 
-        filename = "/buildlogs/%s/%d/%s" % (project.key.id(), travis_job_id, fhint)
-
-        gcs_file = gcs.open(filename, 'w', content_type='text/plain')
-        gcs_file.write(self.request.body)
-        gcs_file.close()
+        scanner = LogScanner(self._tools)
+        filename = store_log(project, travis_job_id, fhint, body,
+                             encoding=self.request.headers.get("Content-Encoding", ""),
+                             scanner=scanner)
+        if filename is None:
+            self.response.write("Wrong HMAC digest recieved")
+            self.response.set_status(404)
+            return
 
         job = self.get_job()
         job.logfiles.append(filename)
-        job.insert_or_update()
+        summarise_log(filename, job, scanner).put_async()
+        self.save(job)
         job.purge_async()
+        job.render_async(LOG_HTML_VERSION)
 
 
 
 class QuartusResultHandler(CustomTravisHookHandler):
 
-    @theopencorps.auth.validate_token("X-Hub-Signature")
-    def post(self, project):
+    _tools = ["quartus"]
+
+    @theopencorps.auth.validate_stream_token("X-Hub-Signature")
+    @idempotent(payload_digest)
+    def post(self, project, body):
         """
         Again, store the logfile, but we also parse stuff out
         """
         travis_job_id = int(self.request.headers.get("Travis-JobID", "0"))
         fhint = self.request.headers.get("Content-Filename", "")
 
+        # Write the logfile back to disk
+        if not fhint:
+            fhint = "unknown"
+        scanner = LogScanner(self._tools)
+        filename = store_log(project, travis_job_id, fhint, body,
+                             encoding=self.request.headers.get("Content-Encoding", ""),
+                             scanner=scanner)
+        if filename is None:
+            self.response.write("Wrong HMAC digest recieved")
+            self.response.set_status(404)
+            return
+
         job = self.get_job()
         build = self.get_build()
 
@@ -80,19 +473,251 @@ class QuartusResultHandler(CustomTravisHookHandler):
                 #attribute = attribute.replate(".", "_")
                 #setattr(synth, attribute, value)
 
-        build.insert_or_update()
         synth.put_async()
 
-        # Write the logfile back to disk
-        if not fhint:
-            fhint = "unknown"
-        filename = "/buildlogs/%s/%d/%s" % (project.key.id(), travis_job_id, fhint)
+        job.logfiles.append(filename)
+        summarise_log(filename, job, scanner).put_async()
+        self.save(job, build)
+        job.purge_async()
+        job.render_async(LOG_HTML_VERSION)
+
+
+# Resumable uploads
+#
+#   POST    .../simulation/log/sessions                 open, returns the session id
+#   PUT     .../simulation/log/sessions/<id>/<n>        chunk n, each signed
+#   GET     .../simulation/log/sessions/<id>            which chunks have arrived
+#   POST    .../simulation/log/sessions/<id>            finalize, body {"chunks": count}
+#
+# Chunks are stored as gzip members (a chunk sent with Content-Encoding: gzip
+# must be a complete gzip file) so composing them gives a gzipped log.
+#
+# Signatures cover a prefix ahead of the body binding them to the request:
+#
+#   open        "open:<Travis-JobID>:<Content-Filename>\n"
+#   chunk n     "<id>:<n>\n"
+#   status      "<id>:status\n"
+#   finalize    "<id>:finalize\n"
+#
+# so that nothing can be replayed against another session or position.
+# Sessions left open for LogUploadSession.lifetime are expired and their
+# chunks deleted.
+
+def open_prefix(handler):
+    return "open:%s:%s\n" % (handler.request.headers.get("Travis-JobID", ""),
+                              handler.request.headers.get("Content-Filename", ""))
+
+def chunk_prefix(handler, session, chunk):
+    return "%s:%d\n" % (session, int(chunk))
 
-        gcs_file = gcs.open(filename, 'w', content_type='text/plain')
-        gcs_file.write(self.request.body)
+def status_prefix(handler, session):
+    return "%s:status\n" % session
+
+def finalize_prefix(handler, session):
+    return "%s:finalize\n" % session
+
+
+def store_chunk(session_id, number, body, encoding=""):
+    """
+    Stream a chunk to storage, returns the object it's in or None if the
+    signature didn't match
+    """
+    obj = "/buildlogs/.incoming/sessions/%s/%d-%s" % (session_id, number, uuid.uuid4().hex)
+    compressor = None
+    if encoding != "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    gcs_file = gcs.open(obj, 'w', content_type='application/x-gzip')
+    try:
+        for chunk in body:
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            gcs_file.write(chunk)
+        if compressor is not None:
+            gcs_file.write(compressor.flush())
+    finally:
         gcs_file.close()
 
-        job.logfiles.append(filename)
-        job.insert_or_update()
+    if not body.verified:
+        logging.warning("Signature didn't match for chunk %d of upload %s", number, session_id)
+        gcs.delete(obj)
+        return None
+    return obj
+
+
+def _delete_quietly(names):
+    for name in names:
+        try:
+            gcs.delete(name)
+        except gcs.NotFoundError:
+            pass
+
+
+class LogSessionBase(CustomTravisHookHandler):
+
+    def write_json(self, data, status=200):
+        self.response.set_status(status)
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps(data))
+
+    def get_session(self, project, session_id):
+        session = LogUploadSession.get_by_id(session_id)
+        if session is None or session.project != project.key:
+            self.write_json({"message": "No upload session %s" % session_id}, status=404)
+            return None
+        return session
+
+
+class LogSessionOpenHandler(LogSessionBase):
+
+    @theopencorps.auth.validate_token("X-Hub-Signature", prefix=open_prefix)
+    def post(self, project):
+        """
+        Start a resumable upload of the log named by Content-Filename
+        """
+        travis_job_id = self._header_id("Travis-JobID")
+        session = LogUploadSession(id=uuid.uuid4().hex,
+                                   project=project.key,
+                                   travis_job=ndb.Key(TravisJob, travis_job_id),
+                                   name=self.request.headers.get("Content-Filename", "unknown"))
+        session.put()
+        session.expire_async()
+        logging.info("Opened upload session %s for %s", session.key.id(), session.name)
+        self.write_json({"session": session.key.id(),
+                         "max_chunks": LogUploadSession.max_chunks}, status=201)
+
+
+class LogSessionHandler(LogSessionBase):
+
+    @theopencorps.auth.validate_token("X-Hub-Signature", prefix=status_prefix)
+    def get(self, project, session):
+        """
+        Report progress so that a client can resume
+        """
+        session = self.get_session(project, session)
+        if session is None:
+            return
+        self.write_json({"state": session.state,
+                         "received": session.received,
+                         "logfile": session.logfile})
+
+    @theopencorps.auth.validate_token("X-Hub-Signature", prefix=finalize_prefix)
+    def post(self, project, session):
+        """
+        Finalize the upload, the log is then put together in the background
+        """
+        session_id = session
+        session = self.get_session(project, session_id)
+        if session is None:
+            return
+        try:
+            count = int(json.loads(self.request.body)["chunks"])
+        except (ValueError, KeyError, TypeError):
+            self.write_json({"message": "Expected {\"chunks\": count}"}, status=400)
+            return
+        if not 0 < count <= LogUploadSession.max_chunks:
+            self.write_json({"message": "Can't compose %d chunks" % count}, status=400)
+            return
+
+        missing = LogUploadSession.finalize(session_id, count)
+        if missing:
+            self.write_json({"message": "Missing chunks", "missing": missing}, status=409)
+            return
+
+        # Record the job and build now, while we have the Travis headers
+        job = self.get_job()
+        build = self.get_build()
+        self.save(job, build)
+        self.write_json({"state": "finalizing"}, status=202)
+
+
+class LogChunkHandler(LogSessionBase):
+
+    @theopencorps.auth.validate_stream_token("X-Hub-Signature", prefix=chunk_prefix)
+    @idempotent(payload_digest)
+    def put(self, project, body, session, chunk):
+        session_id = session
+        session = self.get_session(project, session_id)
+        if session is None:
+            return
+        number = int(chunk)
+        if number >= LogUploadSession.max_chunks or session.state != "open":
+            self.write_json({"message": "Not accepting chunk %d" % number}, status=409)
+            return
+
+        obj = store_chunk(session_id, number, body,
+                          encoding=self.request.headers.get("Content-Encoding", ""))
+        if obj is None:
+            self.write_json({"message": "Wrong HMAC digest recieved"}, status=404)
+            return
+
+        previous = LogUploadSession.add_chunk(session_id, number, obj)
+        if previous is None:
+            gcs.delete(obj)
+            self.write_json({"message": "Upload session %s is closed" % session_id}, status=409)
+            return
+        _delete_quietly([previous] if previous else [])
+        self.write_json({"chunk": number, "length": body.length})
+
+
+class LogSessionFinalizeHandler(theopencorps.auth.BaseSessionHandler):
+
+    def post(self, session_id):
+        """
+        Task queue processor composing the chunks of an upload into a log and
+        doing the same bookkeeping as LogFileHandler
+        """
+        session = LogUploadSession.get_by_id(session_id)
+        if session is None or session.state != "finalizing":
+            logging.warning("Asked to finalize upload %s which isn't ready", session_id)
+            return
+
+        # compose takes the names of the components within the bucket
+        composed = "/buildlogs/.incoming/sessions/%s/composed.gz" % session_id
+        bucket = "/%s/" % composed.split("/")[1]
+        gcs.compose([chunk[len(bucket):] for chunk in session.chunks[:session.count]],
+                    composed, content_type='application/x-gzip')
+
+        digest = hashlib.sha256()
+        scanner = LogScanner(LogFileHandler._tools)
+        try:
+            for text in read_log(composed):
+                digest.update(text)
+                scanner.feed(text)
+        except zlib.error as e:
+            logging.error("Upload %s isn't a valid gzip stream: %s", session_id, repr(e))
+            session.state = "failed"
+            session.put()
+            _delete_quietly([chunk for chunk in session.chunks if chunk] + [composed])
+            return
+        scanner.close()
+
+        # Everything up to completing the session is safe to repeat if the
+        # task is retried, completing it takes the reference exactly once
+        filename = blob_name(digest, session.name)
+        publish_log(composed, filename)
+
+        job = TravisJob(id=session.travis_job.id(), logfiles=[filename]).insert_or_update()
+        summarise_log(filename, job, scanner).put()
         job.purge_async()
+        job.render_async(LOG_HTML_VERSION)
+
+        if not LogUploadSession.complete(session_id, filename):
+            logging.warning("Upload %s was completed by another task", session_id)
+        _delete_quietly([chunk for chunk in session.chunks if chunk] + [composed])
+        logging.info("Upload %s complete as %s", session_id, filename)
 
+
+class LogSessionExpireHandler(theopencorps.auth.BaseSessionHandler):
+
+    def post(self, session_id):
+        """
+        Task queue processor abandoning an upload that was left open
+        """
+        chunks, countdown = LogUploadSession.expire(session_id)
+        if countdown is not None:
+            LogUploadSession(id=session_id).expire_async(countdown=countdown)
+            return
+        if chunks:
+            logging.info("Upload %s expired, deleting %d chunks", session_id, len(chunks))
+            _delete_quietly(chunks)
@@ -33,15 +33,19 @@ import webapp2
 import pusher
 
 from google.appengine.ext import ndb
-from google.appengine.api import taskqueue
 
 import theopencorps
 import theopencorps.auth
 import theopencorps.paths as paths
-from theopencorps.endpoints import HTTPException
-from theopencorps.datamodel.project import ProjectHelper
+from theopencorps.endpoints import RateLimited, RetryPolicy
+from theopencorps.datamodel.project import ProjectHelper, schedule_advance, \
+                                           begin_advance, end_advance
 from theopencorps.datamodel.models import Project, JUnitTestResult, Shield, Repository
 
+# Github repository is asynchronous, may take time to appear if newly created
+_NEW_REPO_RETRY = RetryPolicy(statuses={404: RetryPolicy.IDEMPOTENT},
+                              attempts=6, base=0.05, cap=0.5, deadline=2.0)
+
 class ProjectBaseHandler(theopencorps.auth.BaseSessionHandler):
 
     @webapp2.cached_property
@@ -88,24 +92,33 @@ class ProjectHandler(ProjectBaseHandler):
         """
         fullname = "%s/%s" % (user, repo)
         logging.info("Got a post for %s", fullname)
-        project_key = ndb.Key(Project, fullname)
-        project = project_key.get()
-        repo = project.repo.get()
-        helper = ProjectHelper(project, repo=repo)
-        before = project.failure_count
+        if not begin_advance(fullname):
+            # The holder of the lease may have died without releasing it, so
+            # have the queue retry us rather than relying on it going round
+            logging.info("Already advancing %s, retrying later", fullname)
+            self.response.set_status(503)
+            return
+
+        complete, countdown = True, None
         try:
-            complete = helper.advance()
-        except Exception as e:
+            project_key = ndb.Key(Project, fullname)
+            project = project_key.get()
+            repo = project.repo.get()
+            helper = ProjectHelper(project, repo=repo)
+            try:
+                complete = helper.advance()
+            except RateLimited as e:
+                # Not a failure of the project, just come back when there's quota
+                logging.warning("Deferring %s by %.1fs: %s", fullname, e.retry_after, repr(e))
+                complete, countdown = False, e.retry_after
+            except Exception as e:
+                logging.error("Project task failed: %s", repr(e))
             project.put()
-            logging.error("Project task failed: %s", repr(e))
-            return
-        project.put()
 
-        if not complete:
-            if project.failure_count > before:
-                taskqueue.add(url="/%s" % repo.full_name, countdown=0.5)
-            else:
-                taskqueue.add(url="/%s" % repo.full_name)
+            if not complete and countdown is None:
+                countdown = helper.countdown
+        finally:
+            end_advance(fullname, complete, countdown=countdown)
         return
 
 class NewProjectHandler(ProjectBaseHandler):
@@ -132,7 +145,8 @@ class NewProjectHandler(ProjectBaseHandler):
 
         # Kick off the async requests
         oc_repos_future = Repository.query(Repository.repo_id == repo_info["id"]).fetch_async(2)
-        gh_repo_future = self.gh_user.get_repo_async(gh_username, repo_info["name"])
+        gh_repo_future = self.gh_user.get_repo_async(gh_username, repo_info["name"],
+                                                     retry=_NEW_REPO_RETRY)
 
         pusher_channel = "progress_%d" % uid
         logging.debug("Using Pusher channel %s" % pusher_channel)
@@ -150,19 +164,6 @@ class NewProjectHandler(ProjectBaseHandler):
             update_progress(0, "ERROR: Failed to retrieve Github repository information for id %s" % repo_info['id'])
             return
 
-        # Github repository is asynchronous, may take time to appear if newly created...
-        retry = 1
-        while "full_name" not in gh_repo:
-            logging.warning("Attempt %d to retrieve repository information returned %s", retry, repr(gh_repo))
-            try:
-                gh_repo = self.gh_user.get_repo(gh_username, repo_info["name"])
-            except HTTPException as e:
-                logging.warning(repr(e))
-                time.sleep(0.005)
-                retry += 1
-                if retry >= 10:
-                    break
-
         if 'full_name' not in gh_repo:
             update_progress(0, "Failed to retrieve github repository data.  Please ensure the repository exists and try again")
             return
@@ -232,13 +233,19 @@ class NewProjectHandler(ProjectBaseHandler):
         project.github_webhook = True
         project.put()
         update_progress(100, "%s/%s" % (paths.opencorps_host, repo.full_name))
-        taskqueue.add(url="/%s" % repo.full_name, countdown=0.3)
+        schedule_advance(repo.full_name, countdown=0.3)
         return
 
 
     @theopencorps.auth.login_required
     def get(self):
         gh_user = self.gh_user.user
-        repos = self.gh_user.get_repos()
+        # get_repos() pages lazily, fetch them all here rather than failing
+        # halfway through rendering the template
+        try:
+            repos = list(self.gh_user.get_repos())
+        except Exception as e:
+            logging.error("Failed to list repositories of %s: %s", gh_user["login"], repr(e))
+            repos = []
         template = paths.JINJA_ENVIRONMENT.get_template('new.html')
         self.response.write(template.render(user=self.user, gh_user=gh_user, repos=repos, unique_id=random.getrandbits(31)))
@@ -23,108 +23,343 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import array
+import binascii
+import collections
+import functools
 import logging
+import uuid
 from xml.etree import ElementTree
 
+import cloudstorage as gcs
+
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+
 import theopencorps.auth
 
-from theopencorps.datamodel.models import Push, Project, JUnitTestResult, JUnitTestCase, TravisJob
-from theopencorps.handlers.hooks import CustomTravisHookHandler
+from theopencorps.datamodel.models import Push, Project, JUnitTestResult, JUnitTestCase, TravisJob, \
+                                          JUnitTestOutput, TestCaseDictionary
+from theopencorps.handlers.hooks import CustomTravisHookHandler, idempotent, payload_digest
+from theopencorps.handlers.logs import UploadReader
 from theopencorps.datamodel.project import ProjectHelper
 
 
+# Child elements of a testcase whose text goes in JUnitTestOutput
+_OUTPUT_ELEMENTS = [('failure', 'failure'), ('error', 'error'), ('skipped', 'skipped'),
+                    ('system-out', 'stdout'), ('system-err', 'stderr')]
+
+
 def parse_testcase(tree):
+    """
+    Returns the JUnitTestCase for a testcase element and a dict of its
+    JUnitTestOutput text
+    """
     result = JUnitTestCase()
     result.classname = tree.get('classname', '')
     result.name = tree.get('name', '')
     result.time = float(tree.get('time', "0.0"))
     result.passed = True
+    result.outcome = "passed"
 
     if tree.find('failure') is not None:
         result.passed = False
-        result.failure = tree.find('failure').text
+        result.outcome = "failed"
     if tree.find('error') is not None:
         result.passed = False
-        result.error = tree.find('error').text
+        result.outcome = "error"
     if tree.find('skipped') is not None:
         result.passed = False
-        result.skipped = tree.find('skipped').text
-    if tree.find('system-out') is not None:
-        result.stdout = tree.find('system-out').text
-    if tree.find('system-err') is not None:
-        result.stderr = tree.find('system-err').text
-    return result
+        result.outcome = "skipped"
+
+    text = {}
+    for tag, name in _OUTPUT_ELEMENTS:
+        element = tree.find(tag)
+        if element is not None and element.text:
+            text[name] = element.text
+    result.has_output = bool(text)
+    return result, text
+
+
+class OutputWriter(object):
+    """
+    Puts the JUnitTestOutputs of a result in batches as they are parsed,
+    so the text of a large suite is never all held in memory.  Only to be
+    used once the upload has been verified.
+    """
+    batch = 100
+
+    def __init__(self, result_key):
+        self.result_key = result_key
+        self.keys = []
+        self._pending = []
+        self._futures = []
+
+    def __call__(self, index, text):
+        key = ndb.Key(JUnitTestOutput, index + 1, parent=self.result_key)
+        self._pending.append(JUnitTestOutput(key=key, **text))
+        self.keys.append(key)
+        if len(self._pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._futures.extend(ndb.put_multi_async(self._pending))
+            self._pending = []
+
+    def wait(self):
+        self.flush()
+        for future in self._futures:
+            future.get_result()
+        self._futures = []
+
+    def discard(self):
+        """
+        Delete anything we've written
+        """
+        self.wait()
+        ndb.delete_multi(self.keys)
+
 
-def parse_testsuite(tree):
+def spool_upload(body, name):
     """
-    Takes an element that is the root of a testsuite and creates a JUnitTestResult
+    Stream body (a SignedBody) as it arrived to the temporary object name,
+    so that it can be read again once verified
     """
-    result = JUnitTestResult()
-    result.tests = int(tree.get('tests', '0'))
-    result.errors = int(tree.get('errors', '0'))
-    result.failures = int(tree.get('failures', '0'))
-    result.skipped = int(tree.get('skipped', '0'))
-    result.valid = True
+    with gcs.open(name, 'w', content_type='application/octet-stream') as gcs_file:
+        for chunk in body:
+            gcs_file.write(chunk)
 
-    result.testcases = [parse_testcase(testcase) for testcase in tree.iterfind('testcase')]
+
+def parse_testsuites(source, store_output=None):
+    """
+    Incrementally parse JUnit XML from the file-like source into a single
+    JUnitTestResult, covering a <testsuite> or a <testsuites> holding any
+    number of them.
+
+    Elements are dropped as soon as they've been parsed, so memory doesn't
+    grow with the size of the XML beyond the results themselves.  The text
+    of each testcase is passed to store_output(index, text) if given.
+    """
+    result = JUnitTestResult(tests=0, errors=0, failures=0, skipped=0,
+                             testcases=[], valid=True)
+    suites = 0
+    parents = []
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == 'testcase':
+            testcase, text = parse_testcase(elem)
+            if text and store_output is not None:
+                store_output(len(result.testcases), text)
+            else:
+                testcase.has_output = False
+            result.testcases.append(testcase)
+        elif elem.tag == 'testsuite':
+            suites += 1
+            result.tests += int(elem.get('tests', '0'))
+            result.errors += int(elem.get('errors', '0'))
+            result.failures += int(elem.get('failures', '0'))
+            result.skipped += int(elem.get('skipped', '0'))
+        else:
+            continue
+        if parents:
+            parents[-1].remove(elem)
+        elem.clear()
+
+    if not suites:
+        raise ValueError("No testsuite found")
 
     # Sanity check the numbers?
     result.passed = result.tests - result.errors - result.failures - result.skipped
     total = sum([1 if testcase.passed else 0 for testcase in result.testcases])
 
     if result.passed != total:
-        logging.warning("Invalid XML? Testsuite claims %d tests passed but only found %d",
-                      result.passed, total)
+        logging.warning("Invalid XML? %d testsuites claim %d tests passed but only found %d",
+                      suites, result.passed, total)
     else:
-        logging.info("Testsuite reports %d tests passed", result.passed)
+        logging.info("%d testsuites report %d tests passed", suites, result.passed)
 
     result.time = sum([testcase.time for testcase in result.testcases])
     return result
 
 
 
+# Order of the bitsets in JUnitTestResult.outcomes, one bit per testcase id.
+# "output" marks testcases that have a JUnitTestOutput.
+OUTCOMES = ["passed", "failed", "error", "skipped", "output"]
+
+
+def encode_bitset(ids, size):
+    """
+    Pack ids (all less than size) into a bitset string, bit n of byte n // 8
+    """
+    bits = bytearray((size + 7) // 8)
+    for i in ids:
+        bits[i >> 3] |= 1 << (i & 7)
+    return str(bits)
+
+
+def decode_bitset(data):
+    """
+    The bitset as an integer, so that sets can be combined with & | ^ ~
+    """
+    return int(binascii.hexlify(data[::-1]) or "0", 16)
+
+
+def bitset_ids(value):
+    """
+    The ids set in a decoded bitset
+    """
+    ids = []
+    i = 0
+    while value:
+        if value & 1:
+            ids.append(i)
+        value >>= 1
+        i += 1
+    return ids
+
+
+def testcase_identities(testcases):
+    """
+    The (classname, name, occurrence) of each testcase for
+    TestCaseDictionary.intern, occurrence distinguishing repeated names
+    """
+    seen = collections.defaultdict(int)
+    identities = []
+    for testcase in testcases:
+        name = (testcase.classname, testcase.name)
+        identities.append(name + (seen[name],))
+        seen[name] += 1
+    return identities
+
+
+def encode_testsuite(result, ids):
+    """
+    Replace result.testcases with the packed encoding, ids[n] being the
+    TestCaseDictionary id of result.testcases[n], which must be unique
+    """
+    size = max(ids) + 1 if ids else 0
+    outcomes = dict((outcome, []) for outcome in OUTCOMES)
+    durations = array.array('f', [0.0]) * size
+    for i, testcase in zip(ids, result.testcases):
+        outcomes[testcase.outcome].append(i)
+        if testcase.has_output:
+            outcomes["output"].append(i)
+        durations[i] = testcase.time
+    result.testcase_ids = array.array('I', ids).tostring()
+    result.outcomes = "".join(encode_bitset(outcomes[outcome], size) for outcome in OUTCOMES)
+    result.durations = durations.tostring()
+    result.testcases = []
+
+
+def outcome_bitsets(result):
+    """
+    Returns {outcome: bitset as an integer} for an encoded result.  Results
+    of the same project can be compared with bit operations, e.g. the tests
+    fixed since an earlier result are  new["passed"] & old["failed"]
+    """
+    if not result.outcomes:
+        return dict((outcome, 0) for outcome in OUTCOMES)
+    size = len(result.outcomes) // len(OUTCOMES)
+    return dict((outcome, decode_bitset(result.outcomes[n * size:(n + 1) * size]))
+                                            for n, outcome in enumerate(OUTCOMES))
+
+
+def decode_testsuite(result, dictionary):
+    """
+    Returns the testcases of result as a list of JUnitTestCase, however
+    the result was stored
+    """
+    if not result.testcase_ids:
+        return result.testcases
+    ids = array.array('I')
+    ids.fromstring(result.testcase_ids)
+    durations = array.array('f')
+    durations.fromstring(result.durations)
+    bitsets = outcome_bitsets(result)
+
+    testcases = []
+    for i in ids:
+        classname, name = dictionary.names[i][:2]
+        outcome = [o for o in OUTCOMES[:-1] if bitsets[o] >> i & 1]
+        testcases.append(JUnitTestCase(classname=classname,
+                                       name=name,
+                                       time=durations[i],
+                                       outcome=outcome[0] if outcome else "passed",
+                                       passed=outcome == ["passed"],
+                                       has_output=bool(bitsets["output"] >> i & 1)))
+    return testcases
+
+
 class JunitResultsHandler(CustomTravisHookHandler):
 
-    @theopencorps.auth.validate_token("X-Hub-Signature")
-    def post(self, project):
-        job = self.get_job()
-        build = self.get_build()
+    @theopencorps.auth.validate_stream_token("X-Hub-Signature")
+    @idempotent(payload_digest)
+    def post(self, project, body):
+        # Nothing is parsed until the signature has been checked, so the
+        # upload is spooled to storage first rather than held in memory
+        incoming = "/buildlogs/.incoming/results/%s/%s" % (project.key.id(), uuid.uuid4().hex)
+        spool_upload(body, incoming)
+        try:
+            if not body.verified:
+                logging.warning("Signature didn't match for %d byte results (got %s)",
+                                body.length, body.digest)
+                self.response.write("Wrong HMAC digest recieved")
+                self.response.set_status(404)
+                return
+
+            start, _ = JUnitTestResult.allocate_ids(1)
+            outputs = OutputWriter(ndb.Key(JUnitTestResult, start))
+            with gcs.open(incoming) as gcs_file:
+                chunks = iter(functools.partial(gcs_file.read, body.chunk_size), "")
+                reader = UploadReader(chunks, self.request.headers.get("Content-Encoding", ""))
+                try:
+                    testsuite = parse_testsuites(reader, store_output=outputs)
+                except Exception as e:
+                    logging.warning("Invalid XML supplied: %s", repr(e))
+                    outputs.discard()
+                    self.response.set_status(404)
+                    return
+        finally:
+            gcs.delete(incoming)
 
+        testsuite.key = outputs.result_key
+
+        # Before anything is saved so the upload can simply be retried
         try:
-            root = ElementTree.fromstring(self.request.body)
-        except Exception:
-            logging.warning("Invalid XML supplied")
-            self.response.set_status(404)
+            ids = TestCaseDictionary.intern(project.key, testcase_identities(testsuite.testcases))
+        except datastore_errors.TransactionFailedError as e:
+            logging.warning("Contention interning testcases of %s: %s",
+                            project.key.id(), repr(e))
+            outputs.discard()
+            self.response.set_status(503)
             return
 
-        if root.tag == 'testsuites':
-            suites = list(root.iterfind('testsuite'))
-            if len(suites) != 1:
-                logging.warning("Unable to handle multiple testsuites currently")
-                self.response.set_status(404)
-                return
-            root = suites[0]
+        job = self.get_job()
+        build = self.get_build()
 
-        testsuite = parse_testsuite(root)
         testsuite.travis_job = job.key
         testsuite.travis_build = build.key
         if self.push is not None:
             testsuite.push = self.push.key
         testsuite.project = project.key
-        testsuite.put_async()
 
-        job.insert_or_update()
+        self.save(job, build)
         job.purge_async()
-
-        build.insert_or_update()
         #build.purge_async()
 
-        logging.info("Put %s", repr(testsuite))
-
         helper = ProjectHelper(project)
         helper.update_sim_result(passed=testsuite.passed,
                                  failed=testsuite.failures,
                                  errors=testsuite.errors,
                                  skipped=testsuite.skipped)
-        project.put()
+        encode_testsuite(testsuite, ids)
+
+        outputs.wait()
+        ndb.put_multi([testsuite, project])
+        logging.info("Put %s", repr(testsuite))
 
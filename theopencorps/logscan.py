@@ -0,0 +1,124 @@
+"""
+Find errors, warnings and assertion failures in tool logs
+
+Logs are scanned once as they are uploaded, with a table of patterns per
+tool.  The patterns for the tools that produced a log are combined into a
+single regular expression so each block of the log is only searched once.
+"""
+__copyright__ = """
+Copyright (C) 2016 Potential Ventures Ltd
+
+This file is part of theopencorps
+<https://github.com/theopencorps/theopencorps/>
+"""
+
+__license__ = """
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+
+ERROR = "error"
+WARNING = "warning"
+ASSERTION = "assertion"
+
+# Per tool, in order of precedence, (kind, pattern matching the start of a line)
+PATTERNS = {
+    "vunit": [
+        (ASSERTION, r".* - (?:ERROR|FAILURE) - "),
+        (ERROR,     r"fail \("),
+        (ERROR,     r"Traceback \(most recent call last\)"),
+        (WARNING,   r".* - WARNING - "),
+    ],
+    "modelsim": [
+        (ASSERTION, r"# \*\* (?:Error|Failure|Fatal): .*[Aa]ssert"),
+        (ASSERTION, r"# \*\* Failure: "),
+        (ERROR,     r"# \*\* (?:Error|Fatal)(?: \(suppressible\))?: "),
+        (WARNING,   r"# \*\* Warning(?: \(suppressible\))?: "),
+    ],
+    "quartus": [
+        (ERROR,     r"Error(?: \(\d+\))?: "),
+        (WARNING,   r"Critical Warning(?: \(\d+\))?: "),
+        (WARNING,   r"Warning(?: \(\d+\))?: "),
+    ],
+}
+
+# Lines may start with colour codes
+_ANSI = r"(?:\x1b\[[0-9;]*[A-Za-z])*"
+_ANSI_RE = re.compile(_ANSI)
+
+_compiled = {}
+
+
+def compile_patterns(tools):
+    """
+    Returns the combined pattern for tools and the kind matched by each group
+    """
+    tools = tuple(tools)
+    if tools not in _compiled:
+        kinds = []
+        alternatives = []
+        for tool in tools:
+            for kind, pattern in PATTERNS[tool]:
+                alternatives.append("(%s)" % pattern)
+                kinds.append(kind)
+        regex = re.compile(r"^%s(?:%s).*$" % (_ANSI, "|".join(alternatives)), re.MULTILINE)
+        _compiled[tools] = (regex, kinds)
+    return _compiled[tools]
+
+
+class LogScanner(object):
+    """
+    Scans text fed to it in arbitrary chunks
+
+        tools           names of the entries in PATTERNS to use
+        max_entries     stop recording (but keep counting) after this many
+
+    entries are (kind, line, offset, text) with line counted from 0 and
+    offset the byte offset of the start of the line.
+    """
+    _max_text = 200
+
+    def __init__(self, tools, max_entries=1000):
+        self.tools = list(tools)
+        self.max_entries = max_entries
+        self._regex, self._kinds = compile_patterns(self.tools)
+        self._partial = ""
+        self.lines = 0
+        self.offset = 0
+        self.counts = dict((kind, 0) for kind in (ERROR, WARNING, ASSERTION))
+        self.entries = []
+
+    def feed(self, chunk):
+        text = self._partial + chunk
+        end = text.rfind("\n") + 1
+        self._partial = text[end:]
+        self._scan(text[:end])
+
+    def close(self):
+        self._scan(self._partial)
+        self._partial = ""
+
+    def _scan(self, text):
+        line, position = self.lines, 0
+        for match in self._regex.finditer(text):
+            line += text.count("\n", position, match.start())
+            position = match.start()
+            kind = self._kinds[match.lastindex - 1]
+            self.counts[kind] += 1
+            if len(self.entries) < self.max_entries:
+                self.entries.append((kind, line, self.offset + position,
+                                     _ANSI_RE.sub("", match.group(0))[:self._max_text]))
+        self.lines += text.count("\n")
+        self.offset += len(text)
@@ -61,12 +61,21 @@ ROUTES = [
     webapp2.Route(r'/login',                              theopencorps.auth.LoginHandler),
     webapp2.Route(r'/logout',                             theopencorps.auth.LogoutHandler),
     webapp2.Route(r'/new',                                theopencorps.handlers.projects.NewProjectHandler),
+    # Two segment routes must precede /<user>/<repo>
+    webapp2.Route(r'/logs/collect',                       theopencorps.handlers.logs.LogCollectHandler),
     webapp2.Route(r'/<user>/<repo>',                      theopencorps.handlers.projects.ProjectHandler),
     webapp2.Route(r'/<user>/<repo>/simulation/results',   theopencorps.handlers.results.JunitResultsHandler),
     webapp2.Route(r'/<user>/<repo>/simulation/log',       theopencorps.handlers.logs.LogFileHandler),
+    webapp2.Route(r'/<user>/<repo>/simulation/log/sessions', theopencorps.handlers.logs.LogSessionOpenHandler),
+    webapp2.Route(r'/<user>/<repo>/simulation/log/sessions/<session>', theopencorps.handlers.logs.LogSessionHandler),
+    webapp2.Route(r'/<user>/<repo>/simulation/log/sessions/<session>/<chunk:\d+>', theopencorps.handlers.logs.LogChunkHandler),
     webapp2.Route(r'/<user>/<repo>/commit',               theopencorps.handlers.hooks.GithubWebHookHandler),
     webapp2.Route(r'/<user>/<repo>/commits/<sha1>',       theopencorps.handlers.builds.BuildHandler),
+    webapp2.Route(r'/<user>/<repo>/commits/<sha1>/logs/<name>', theopencorps.handlers.builds.LogViewHandler),
     webapp2.Route(r'/jobs/<job_id>/purge',                theopencorps.handlers.hooks.JobPurgeHandler),
+    webapp2.Route(r'/jobs/<job_id>/render',               theopencorps.handlers.logs.JobRenderHandler),
+    webapp2.Route(r'/logs/sessions/<session_id>/finalize', theopencorps.handlers.logs.LogSessionFinalizeHandler),
+    webapp2.Route(r'/logs/sessions/<session_id>/expire',   theopencorps.handlers.logs.LogSessionExpireHandler),
     webapp2.Route(r'/',                                   MainPage),
     webapp2.Route(r'/docs',                               DocsPage),
     ]